@@ -0,0 +1,203 @@
+# Copyright (c) 2014 Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from vdf import load, load_chars, dump
+from binary import Buffer
+from pcf import PCF, PCFScan, splice_systems
+from collections import OrderedDict
+from io import BytesIO, StringIO
+from struct import pack
+from sys import argv
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+def synthetic_items_game(n):
+    s = StringIO()
+    s.write('"items_game"\n{\n\t"items"\n\t{\n')
+    for i in range(n):
+        s.write('\t\t"{}"\n\t\t{{\n'.format(i))
+        s.write('\t\t\t"name"\t\t"Item {}"\n'.format(i))
+        s.write('\t\t\t"prefab"\t\t"wearable"\n')
+        s.write('\t\t\t"model_player"\t\t"models/heroes/hero_{0}/item_{0}.mdl"\n'.format(i))
+        s.write('\t\t\t// comment {}\n'.format(i))
+        s.write('\t\t\t"used_by_heroes"\n\t\t\t{{\n\t\t\t\t"npc_dota_hero_{}"\t\t"1"\n\t\t\t}}\n'.format(i % 100))
+        s.write('\t\t\t"visuals"\n\t\t\t{\n')
+        for j in range(3):
+            s.write('\t\t\t\t"asset_modifier{}"\n\t\t\t\t{{\n'.format(j))
+            s.write('\t\t\t\t\t"type"\t\t"particle"\n')
+            s.write('\t\t\t\t\t"asset"\t\t"system_{}"\n'.format(j))
+            s.write('\t\t\t\t\t"modifier"\t\t"system_{}_{}"\n'.format(i, j))
+            s.write('\t\t\t\t}\n')
+        s.write('\t\t\t}\n\t\t}\n')
+    s.write('\t}\n}\n')
+    return s.getvalue()
+
+def timed(f, *args):
+    start = perf_counter()
+    result = f(*args)
+    return result, perf_counter() - start
+
+def dumped(d):
+    s = StringIO()
+    dump(d, s)
+    return s.getvalue()
+
+def bench_vdf(n=20000):
+    text = synthetic_items_game(n)
+    print("vdf: {} items, {} characters".format(n, len(text)))
+    old, old_time = timed(load_chars, StringIO(text))
+    old = dumped(old)
+    new, new_time = timed(load, StringIO(text))
+    assert old == dumped(new)
+    print("load_chars: {:.3f}s".format(old_time))
+    print("load: {:.3f}s ({:.1f}x)".format(new_time, old_time / new_time))
+    del new
+    _, paths_time = timed(load, StringIO(text), ["items_game/items/0"])
+    print("load with paths: {:.3f}s ({:.1f}x)".format(paths_time, old_time / paths_time))
+
+def synthetic_pcf(n, attributes=20):
+    s = BytesIO()
+    s.write(b"<!-- dmx encoding binary 5 format pcf 2 -->\n\0")
+    strings = ["DmElement", "DmeParticleSystemDefinition", "DmeParticleOperator", "particleSystemDefinitions", "functionName", "children"]
+    strings += ["attribute_{}".format(i) for i in range(attributes)]
+    strings += ["system_{}".format(i) for i in range(n)]
+    s.write(pack("<I", len(strings)))
+    for string in strings:
+        s.write(string.encode() + b"\0")
+    s.write(pack("<I", n + 1))
+    s.write(pack("<II", 0, 0) + bytes(16))
+    for i in range(n):
+        s.write(pack("<II", 1 + i % 2, 6 + attributes + i) + pack("<QQ", i + 1, i))
+    s.write(pack("<II", 1, 3) + pack("<BI", 15, n) + b"".join(pack("<I", i + 1) for i in range(n)))
+    for i in range(n):
+        s.write(pack("<I", attributes))
+        for j in range(attributes):
+            kind = j % 5
+            s.write(pack("<I", 6 + j))
+            if kind == 0:
+                s.write(pack("<Bf", 3, j))
+            elif kind == 1:
+                s.write(pack("<B3f", 10, i, j, 0))
+            elif kind == 2:
+                s.write(pack("<BI", 2, i))
+            elif kind == 3:
+                s.write(pack("<BI", 5, 4))
+            else:
+                s.write(pack("<BI4f", 17, 4, 0, 1, 2, 3))
+    return s.getvalue()
+
+def bench_pcf_memory(n=5000):
+    data = synthetic_pcf(n)
+    print("pcf: {} elements, {} bytes".format(n, len(data)))
+    _, unpack_time = timed(PCF().unpack, Buffer(data))
+    print("unpack: {:.3f}s".format(unpack_time))
+    p = PCF()
+    start()
+    p.unpack(Buffer(data))
+    current, peak = get_traced_memory()
+    stop()
+    print("memory: {:.1f} MB held, {:.1f} MB peak, {:.0f} bytes per element".format(current / 1e6, peak / 1e6, current / n))
+
+def synthetic_particles(n, prefix, file_id, operators=4, attributes=10):
+    # n particle systems with their own operators, all of them listed in the
+    # root element
+    s = BytesIO()
+    s.write(b"<!-- dmx encoding binary 5 format pcf 2 -->\n\0")
+    strings = ["DmElement", "DmeParticleSystemDefinition", "DmeParticleOperator", "particleSystemDefinitions", "operators", "functionName", "operator"]
+    strings += ["attribute_{}".format(i) for i in range(attributes)]
+    strings += ["{}_{}".format(prefix, i) for i in range(n)]
+    s.write(pack("<I", len(strings)))
+    for string in strings:
+        s.write(string.encode() + b"\0")
+    systems = 7 + attributes
+    s.write(pack("<I", 1 + n + n * operators))
+    s.write(pack("<II", 0, 0) + bytes(16))
+    for i in range(n):
+        s.write(pack("<II", 1, systems + i) + pack("<QQ", i + 1, file_id))
+    for i in range(n * operators):
+        s.write(pack("<II", 2, 6) + pack("<QQ", n + i + 1, file_id))
+    s.write(pack("<I", 1) + pack("<IBI", 3, 15, n) + b"".join(pack("<I", i + 1) for i in range(n)))
+    for i in range(n):
+        s.write(pack("<I", attributes + 1))
+        s.write(pack("<IBI", 4, 15, operators))
+        s.write(b"".join(pack("<I", 1 + n + i * operators + j) for j in range(operators)))
+        for j in range(attributes):
+            if j % 2:
+                s.write(pack("<IB3f", 7 + j, 10, i, j, 0))
+            else:
+                s.write(pack("<IBI", 7 + j, 2, i))
+    for i in range(n * operators):
+        s.write(pack("<I", 1 + attributes))
+        s.write(pack("<IBI", 5, 5, systems + i % n))
+        for j in range(attributes):
+            s.write(pack("<IBf", 7 + j, 3, j))
+    return s.getvalue()
+
+def pcf_tree(data):
+    # the elements reachable from the root, without guids
+    p = PCF()
+    p.unpack(Buffer(data))
+    def element(e):
+        attributes = []
+        for attribute in e.attribute:
+            value = attribute["data"].data
+            if attribute["type"].data == 1:
+                value = element(value)
+            elif attribute["type"].data == 15:
+                value = [element(ref) for ref in value]
+            attributes.append((attribute["name"].data, attribute["type"].data, value))
+        return (e["type"].data, e["name"].data, attributes)
+    return element(p["elements"][0])
+
+def rewritten(data, replacements, source):
+    p = PCF()
+    p.unpack(Buffer(data))
+    p.minimize()
+    copied = {}
+    for ref in p["elements"][0].attribute[0]["data"].data:
+        name = ref["name"].data
+        if name in replacements:
+            if replacements[name] is None:
+                ref.attribute.data = []
+            else:
+                p.copy_system(ref, source[replacements[name][1]], copied)
+    s = BytesIO()
+    s.name = "rewritten"
+    p.full_pack(s)
+    return s.getvalue()
+
+def spliced(data, replacements, source):
+    return splice_systems(PCFScan(data), replacements)
+
+def bench_pcf_splice(n=2000):
+    # like fix_particles: a third of the systems emptied, a third replaced
+    data = synthetic_particles(n, "system", 1)
+    source_data = synthetic_particles(n // 3, "default", 2)
+    print("pcf: {} systems, {} bytes".format(n, len(data)))
+    source = PCF()
+    source.unpack(Buffer(source_data))
+    source = dict((e["name"].data, e) for e in source["elements"] if e["type"].data == "DmeParticleSystemDefinition")
+    source_scan = PCFScan(source_data)
+    replacements = OrderedDict()
+    splice_replacements = OrderedDict()
+    for i in range(0, n - 2, 3):
+        replacements["system_{}".format(i)] = None
+        splice_replacements["system_{}".format(i)] = None
+        replacements["system_{}".format(i + 1)] = (None, "default_{}".format(i // 3))
+        splice_replacements["system_{}".format(i + 1)] = (source_scan, "default_{}".format(i // 3))
+    old, old_time = timed(rewritten, data, replacements, source)
+    new, new_time = timed(spliced, data, splice_replacements, source)
+    assert pcf_tree(old) == pcf_tree(new)
+    print("unpack, minimize and full_pack: {:.3f}s, {} bytes".format(old_time, len(old)))
+    print("splice_systems: {:.3f}s ({:.1f}x), {} bytes".format(new_time, old_time / new_time, len(new)))
+
+benchmarks = {
+    "vdf": bench_vdf,
+    "pcf_memory": bench_pcf_memory,
+    "pcf_splice": bench_pcf_splice,
+}
+
+if __name__ == "__main__":
+    name = argv[1]
+    args = [int(arg) for arg in argv[2:]]
+    benchmarks[name](*args)
@@ -1,8 +1,18 @@
 # Copyright (c) 2013 Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from struct import pack, unpack, calcsize
+from struct import pack, Struct as CompiledFormat
 from collections import OrderedDict
+from copy import copy
+from array import array
+from itertools import chain
+from struct import calcsize
+from sys import byteorder, stderr
+from os import environ
+from time import perf_counter
+from atexit import register
+import json
+from mmap import mmap, ACCESS_READ
 
 def getbytes(s, n):
     b = s.read(n)
@@ -12,6 +22,133 @@ def getbytes(s, n):
 def getbyte(s):
     return getbytes(s, 1)
 
+def getview(s, n):
+    if type(s) is Buffer:
+        return s.view(n)
+    return getbytes(s, n)
+
+def remaining(s):
+    if type(s) is Buffer:
+        return s.size - s.pos
+    pos = s.tell()
+    end = s.seek(0, 2)
+    s.seek(pos)
+    return end - pos
+
+def unpack_compiled(s, compiled):
+    if type(s) is Buffer:
+        return s.unpack(compiled)
+    return compiled.unpack(getbytes(s, compiled.size))
+
+def read_string(s, block_size=64):
+    if type(s) is Buffer:
+        return s.read_strings(1)[0]
+    chunks = []
+    while True:
+        block = s.read(block_size)
+        end = block.find(b"\0")
+        if end >= 0:
+            s.seek(end + 1 - len(block), 1)
+            chunks.append(block[:end])
+            return b"".join(chunks).decode()
+        assert block, "Unexpected EOF"
+        chunks.append(block)
+
+def read_strings(s, n, block_size=4096):
+    if type(s) is Buffer:
+        return s.read_strings(n)
+    strings = []
+    rest = b""
+    while len(strings) < n:
+        block = s.read(block_size)
+        assert block, "Unexpected EOF"
+        parts = (rest + block).split(b"\0")
+        rest = parts.pop()
+        strings.extend(parts)
+    # give back what was read past the last string
+    extra = len(rest) + sum(len(part) + 1 for part in strings[n:])
+    s.seek(-extra, 1)
+    return [part.decode() for part in strings[:n]]
+
+class Buffer(object):
+    # stream over bytes, a memoryview or an mmap, decoded in place
+    def __init__(self, data, name=None):
+        self.data = data
+        self.size = len(data)
+        self.pos = 0
+        self.name = name
+        if hasattr(data, "find"):
+            self.find = data.find
+        else:
+            self.find = self.find_in_view
+
+    def read(self, n=-1):
+        start = self.pos
+        if n < 0 or start + n > self.size:
+            end = self.size
+        else:
+            end = start + n
+        self.pos = end
+        return bytes(self.data[start:end])
+
+    def view(self, n):
+        start = self.pos
+        end = start + n
+        assert end <= self.size, "Unexpected EOF"
+        self.pos = end
+        return memoryview(self.data)[start:end]
+
+    def unpack(self, compiled):
+        start = self.pos
+        end = start + compiled.size
+        assert end <= self.size, "Unexpected EOF"
+        self.pos = end
+        return compiled.unpack_from(self.data, start)
+
+    def find_in_view(self, sub, start):
+        # memoryviews have no find
+        while start < self.size:
+            block = bytes(self.data[start:start + 4096])
+            end = block.find(sub)
+            if end >= 0:
+                return start + end
+            start += len(block) - len(sub) + 1
+        return -1
+
+    def read_strings(self, n):
+        data = self.data
+        find = self.find
+        pos = self.pos
+        strings = []
+        for i in range(n):
+            end = find(b"\0", pos)
+            assert end >= 0, "Unexpected EOF"
+            strings.append(bytes(data[pos:end]).decode())
+            pos = end + 1
+        self.pos = pos
+        return strings
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+def map_file(path):
+    # the mapping stays open for as long as something refers to the buffer
+    with open(path, "rb") as s:
+        data = mmap(s.fileno(), 0, access=ACCESS_READ)
+    return Buffer(data, path)
+
+def unpack_file(field, path):
+    field.unpack(map_file(path))
+    return field
+
 class Seek(object):
     def __init__(self, s, *args, **kwargs):
         self.old_pos = None
@@ -40,7 +177,254 @@ class FakeWriteStream(object):
     def write(self, data):
         self.offset += len(data)
 
+class LayoutStream(FakeWriteStream):
+    # resolves index tables in a single pack, fields appended behind the
+    # current position are laid out as soon as they are appended
+    def __init__(self, offset, name):
+        FakeWriteStream.__init__(self, offset, name)
+        self.start = offset
+        self.appended_size = 0
+        self.generation = 1
+        # passes the old fixed point loop needed before its final pack
+        self.passes = 1
+
+    def note_change(self, appended=None):
+        self.passes = max(self.passes, self.generation + 1)
+        if appended is not None:
+            # the old loop only packed these on its next pass
+            offset = self.offset
+            self.generation += 1
+            appended.pack(self)
+            self.generation -= 1
+            self.appended_size += self.offset - offset
+            self.offset = offset
+
+    @property
+    def size(self):
+        return self.offset - self.start + self.appended_size
+
+class ByteWriter(object):
+    def __init__(self, offset, name, size=0):
+        self.start = offset
+        self.offset = offset
+        self.end = 0
+        self.name = name
+        self.buffer = bytearray(size)
+        self.changes = 0
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        start = self.offset - self.start
+        end = start + len(data)
+        self.buffer[start:end] = data
+        self.offset += len(data)
+        self.end = max(self.end, end)
+
+    def note_change(self, appended=None):
+        self.changes += 1
+
+    def getvalue(self):
+        return memoryview(self.buffer)[:self.end]
+
+def note_change(s, appended=None):
+    note = getattr(s, "note_change", None)
+    if note is not None:
+        note(appended)
+
+compiled_formats = {}
+
+def compile_format(fmt):
+    compiled = compiled_formats.get(fmt)
+    if compiled is None:
+        compiled = CompiledFormat(fmt)
+        compiled_formats[fmt] = compiled
+    return compiled
+
+def array_typecode(bosa, fmt):
+    # array.array typecode for formats that repeat one integer or float code
+    codes = set(fmt) - set("0123456789")
+    if bosa == "@" or len(codes) != 1:
+        return None
+    code = codes.pop()
+    if code in "fd":
+        candidates = "fd"
+    elif code in "bhilq":
+        candidates = "bhilq"
+    elif code in "BHILQ":
+        candidates = "BHILQ"
+    else:
+        return None
+    for typecode in candidates:
+        if array(typecode).itemsize == calcsize("<" + code):
+            return typecode
+    return None
+
+class FormatCodec(object):
+    # everything about a format string, shared by all Format fields using it
+    __slots__ = ("bosa", "fmt", "single", "compiled", "count", "typecode", "swap")
+
+    def __init__(self, fmt):
+        if fmt[0] in "@=<>!":
+            self.bosa = fmt[0]
+            self.fmt = fmt[1:]
+        else:
+            self.bosa = "<"
+            self.fmt = fmt
+        self.single = len(self.fmt) == 1
+        self.compiled = compile_format(self.bosa + self.fmt)
+        self.count = len(self.compiled.unpack(bytes(self.compiled.size)))
+        self.typecode = array_typecode(self.bosa, self.fmt)
+        self.swap = self.bosa in "<>!" and (self.bosa == "<") != (byteorder == "little")
+
+format_codecs = {}
+
+def format_codec(fmt):
+    codec = format_codecs.get(fmt)
+    if codec is None:
+        codec = FormatCodec(fmt)
+        format_codecs[fmt] = codec
+    return codec
+
+def unpack_bulk(s, codec, n):
+    bulk = array(codec.typecode)
+    bulk.frombytes(getview(s, codec.compiled.size * n))
+    if codec.swap:
+        bulk.byteswap()
+    return bulk
+
+def make_bulk(codec, data):
+    if codec.single:
+        return array(codec.typecode, data)
+    return array(codec.typecode, chain.from_iterable(data))
+
+def pack_bulk(s, codec, bulk):
+    if codec.swap:
+        bulk = array(codec.typecode, bulk)
+        bulk.byteswap()
+    s.write(bulk.tobytes())
+
+class FormatRun(object):
+    # adjacent Format fields decoded with a single unpack
+    def __init__(self, fields):
+        self.compiled = compile_format(fields[0][1].codec.bosa + "".join(f.codec.fmt for name, f in fields))
+        self.length = len(fields)
+        # (name, field class, format codec, slice of the unpacked values)
+        self.slots = []
+        self.ends = []
+        start = 0
+        end = 0
+        for name, f in fields:
+            codec = f.codec
+            self.slots.append((name, type(f), codec, slice(start, start + codec.count)))
+            start += codec.count
+            end += codec.compiled.size
+            self.ends.append(end)
+        self.hits = 0
+        self.misses = 0
+
+def run_eligible(f):
+    cls = type(f)
+    return cls.unpack_data is Format.unpack_data and cls.unpack is BaseField.unpack and f.codec.bosa in "<>!="
+
+# Struct subclass -> {call position: FormatRun}, recorded on the first unpack
+run_plans = {}
+
+class RunReader(object):
+    def __init__(self, s, plan):
+        self.s = s
+        self.plan = plan
+        if plan is None:
+            self.recorded = []
+        else:
+            self.recorded = None
+        self.position = 0
+        self.run = None
+        self.values = None
+        self.index = 0
+
+    def unpack(self, name, f):
+        position = self.position
+        self.position = position + 1
+        run = self.run
+        if run is not None:
+            slot = run.slots[self.index]
+            if slot[0] == name and slot[1] is type(f) and slot[2] is f.codec:
+                self.index += 1
+                if self.index == run.length:
+                    run.hits += 1
+                    self.run = None
+                f.data = f.convert(self.values[slot[3]])
+                return
+            self.abandon()
+        elif self.plan:
+            run = self.plan.get(position)
+            if run is not None and run.hits >= run.misses:
+                slot = run.slots[0]
+                # a shorter branch near the end can leave less than the run
+                if slot[0] == name and slot[1] is type(f) and slot[2] is f.codec and remaining(self.s) >= run.compiled.size:
+                    self.values = unpack_compiled(self.s, run.compiled)
+                    self.run = run
+                    self.index = 1
+                    f.data = f.convert(self.values[slot[3]])
+                    return
+        if self.recorded is not None:
+            self.recorded.append((position, name, f))
+        f.unpack(self.s)
+
+    def abandon(self):
+        # the fields diverged from the recorded run, give back the unused bytes
+        run = self.run
+        run.misses += 1
+        self.s.seek(self.s.tell() - run.compiled.size + run.ends[self.index - 1])
+        self.run = None
+
+    def finish(self, cls):
+        if self.run is not None:
+            self.abandon()
+        if self.recorded is not None:
+            plan = {}
+            fields = []
+            last = None
+            for position, name, f in self.recorded + [(None, None, None)]:
+                if f is not None and fields and run_eligible(f) and position == last + 1 and fields[0][1].codec.bosa == f.codec.bosa:
+                    fields.append((name, f))
+                else:
+                    if len(fields) > 1:
+                        plan[first] = FormatRun(fields)
+                    if f is not None and run_eligible(f):
+                        fields = [(name, f)]
+                        first = position
+                    else:
+                        fields = []
+                last = position
+            run_plans[cls] = plan
+
+# bumped whenever field data is set or fields are added or removed,
+# container data views built in an older generation are rebuilt
+generation = 0
+
+def data_changed():
+    global generation
+    generation += 1
+
 class BaseField(object):
+    __slots__ = ("value",)
+
+    @property
+    def data(self):
+        return self.value
+
+    @data.setter
+    def data(self, v):
+        global generation
+        generation += 1
+        self.value = v
+
     def unpack(self, s):
         self.data = self.unpack_data(s)
 
@@ -54,19 +438,28 @@ class BaseField(object):
         raise NotImplementedError
 
     def full_pack(self, s):
-        new_data = self.data
+        # returns the number of packs done and the number the old fixed point
+        # loop would have needed
+        layout = LayoutStream(s.tell(), s.name)
+        self.pack(layout)
+        packs = 1
+        size = layout.size
         while True:
-            old_data = new_data
-            self.pack(FakeWriteStream(s.tell(), s.name))
-            new_data = self.data
-            if old_data == new_data:
+            writer = ByteWriter(s.tell(), s.name, size)
+            self.pack(writer)
+            packs += 1
+            if not writer.changes:
                 break
-        self.pack(s)
+            size = writer.end
+        s.write(writer.getvalue())
+        return packs, layout.passes + 1
 
     def serialize(self):
         return self.data
 
 class ContainerField(BaseField):
+    __slots__ = ()
+
     def __getitem__(self, key):
         return self.field[key]
 
@@ -85,19 +478,91 @@ class ContainerField(BaseField):
     def __contains__(self, key):
         return key in self.field
 
+class Schema(object):
+    # field names of a struct and their positions, shared by all instances
+    # that added the same fields in the same order
+    __slots__ = ("names", "index", "children")
+
+    def __init__(self, names):
+        self.names = names
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self.children = {}
+
+    def child(self, name):
+        child = self.children.get(name)
+        if child is None:
+            assert name not in self.index, name
+            child = Schema(self.names + (name,))
+            self.children[name] = child
+        return child
+
+# Struct subclass -> Schema without fields
+struct_schemas = {}
+
+def root_schema(cls):
+    schema = struct_schemas.get(cls)
+    if schema is None:
+        schema = Schema(())
+        struct_schemas[cls] = schema
+    return schema
+
+# shared by all structs without keyword arguments, never modified
+no_kwargs = {}
+
 class Struct(ContainerField):
+    __slots__ = ("args", "kwargs", "schema", "values", "input", "cached")
+
     def __init__(self, *args, **kwargs):
         self.args = args
-        self.kwargs = kwargs
+        self.kwargs = kwargs or no_kwargs
+        self.cached = None
+
+    def __getitem__(self, key):
+        return self.values[self.schema.index[key]]
+
+    def __setitem__(self, key, value):
+        i = self.schema.index.get(key)
+        if i is None:
+            self.schema = self.schema.child(key)
+            self.values.append(value)
+        else:
+            self.values[i] = value
+        data_changed()
+
+    def __delitem__(self, key):
+        i = self.schema.index[key]
+        del self.values[i]
+        data_changed()
+        names = self.schema.names
+        schema = root_schema(type(self))
+        for name in names[:i] + names[i + 1:]:
+            schema = schema.child(name)
+        self.schema = schema
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def __contains__(self, key):
+        return key in self.schema.index
+
+    def items(self):
+        return zip(self.schema.names, self.values)
+
+    @property
+    def field(self):
+        return OrderedDict(self.items())
 
     def add_field(self, name, f):
-        assert name not in self, name
-        self[name] = f
+        self.schema = self.schema.child(name)
+        self.values.append(f)
         input_type, v = self.input
         if input_type == "data":
             f.data = v.get(name, None)
         elif input_type == "stream":
-            f.unpack(v)
+            v.unpack(name, f)
         else:
             assert False, input_type
         return f
@@ -106,32 +571,44 @@ class Struct(ContainerField):
         return self.add_field(name, f)
 
     def unpack(self, s):
-        self.field = OrderedDict()
-        self.input = ("stream", s)
+        self.schema = root_schema(type(self))
+        self.values = []
+        data_changed()
+        reader = RunReader(s, run_plans.get(type(self)))
+        self.input = ("stream", reader)
         self.fields(*self.args, **self.kwargs)
         del self.input
+        reader.finish(type(self))
 
     def pack(self, s):
-        for name, f in self.field.items():
+        for f in self.values:
             f.pack(s)
 
     @property
     def data(self):
+        # the view is shared between reads, don't modify it
+        cached = self.cached
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        current = generation
         data = OrderedDict()
-        for k, v in self.field.items():
+        for k, v in self.items():
             data[k] = v.data
+        self.cached = (current, data)
         return data
 
     @data.setter
     def data(self, v):
-        self.field = OrderedDict()
+        self.schema = root_schema(type(self))
+        self.values = []
+        data_changed()
         self.input = ("data", v)
         self.fields(*self.args, **self.kwargs)
         del self.input
 
     def serialize(self):
         data = OrderedDict()
-        for k, v in self.field.items():
+        for k, v in self.items():
             data[k] = v.serialize()
         return data
 
@@ -139,6 +616,8 @@ class Struct(ContainerField):
         raise NotImplementedError
 
 class Magic(BaseField):
+    __slots__ = ("magic",)
+
     def __init__(self, magic):
         if isinstance(magic, str):
             magic = magic.encode()
@@ -160,70 +639,199 @@ class Magic(BaseField):
         assert v == self.magic or v is None, v
 
 class Format(BaseField):
+    __slots__ = ("codec",)
+
     def __init__(self, fmt):
-        if fmt[0] in "@=<>!":
-            bosa = fmt[0]
-            fmt = fmt[1:]
-        else:
-            bosa = "<"
-        self.bosa = bosa
-        self.fmt = fmt
-        self.single = len(fmt) == 1
+        self.codec = format_codec(fmt)
 
     def unpack_data(self, s):
-        fmt = self.bosa + self.fmt
-        size = calcsize(fmt)
-        b = getbytes(s, size)
-        data = unpack(fmt, b)
-        if self.single:
+        return self.convert(unpack_compiled(s, self.codec.compiled))
+
+    def convert(self, data):
+        if self.codec.single:
             assert len(data) == 1
             data = data[0]
         return data
 
     def pack_data(self, s, data):
-        if self.single:
+        if self.codec.single:
             data = (data,)
-        s.write(pack(self.fmt, *data))
+        s.write(pack(self.codec.fmt, *data))
+
+def field_data(f):
+    return f.data
 
 class BaseArray(ContainerField):
+    __slots__ = ("field_maker", "field_fun", "fields", "bulk", "element_codec", "indexes", "cached")
+
     def __init__(self, field_maker=None, field_function=None):
-        if field_function is None:
-            field_function = lambda i, f: field_maker()
+        self.field_maker = field_maker
         self.field_fun = field_function
+        self.fields = None
+        # Format elements that fit an array.array are kept in one, see field
+        self.bulk = None
+        self.element_codec = False
+        # key function -> {key: first index}, see index_of
+        self.indexes = None
+        self.cached = None
+
+    def make_fields(self, n):
+        if self.field_fun is None:
+            field_maker = self.field_maker
+            return [field_maker() for i in range(n)]
+        return [self.field_fun(i, self) for i in range(n)]
+
+    def bulk_codec(self):
+        # codec of the elements if they are plain Format fields that fit an array.array
+        if self.element_codec is False:
+            self.element_codec = None
+            if self.field_fun is None:
+                f = self.field_maker()
+                if type(f) is Format and f.codec.typecode is not None:
+                    self.element_codec = f.codec
+        return self.element_codec
+
+    @property
+    def field(self):
+        if self.fields is None:
+            # materialize the bulk elements as Format fields
+            codec = self.element_codec
+            bulk = self.bulk
+            fields = self.make_fields(len(bulk) // codec.count)
+            if codec.single:
+                for f, v in zip(fields, bulk):
+                    f.value = v
+            else:
+                count = codec.count
+                for i, f in enumerate(fields):
+                    f.value = tuple(bulk[i * count:(i + 1) * count])
+            self.fields = fields
+            self.bulk = None
+        return self.fields
+
+    @field.setter
+    def field(self, v):
+        self.fields = v
+        self.bulk = None
+
+    def __len__(self):
+        if self.fields is None:
+            return len(self.bulk) // self.element_codec.count
+        return len(self.fields)
 
     def unpack(self, s):
-        self.field = [self.field_fun(i, self) for i in range(self.size)]
+        codec = self.bulk_codec()
+        self.indexes = None
+        data_changed()
+        if codec is not None:
+            self.fields = None
+            self.bulk = unpack_bulk(s, codec, self.size)
+            return
+        self.field = self.make_fields(self.size)
         for f in self:
             f.unpack(s)
 
+    def __setitem__(self, key, value):
+        self.field[key] = value
+        self.indexes = None
+        data_changed()
+
+    def __delitem__(self, key):
+        del self.field[key]
+        self.indexes = None
+        data_changed()
+
+    def index_of(self, value, key=field_data):
+        # like list.index on the keys, the index is built on first use and
+        # kept up to date by append_data
+        if self.indexes is None:
+            self.indexes = {}
+        index = self.indexes.get(key)
+        if index is None:
+            index = {}
+            for i, f in enumerate(self.field):
+                index.setdefault(key(f), i)
+            self.indexes[key] = index
+        try:
+            return index[value]
+        except KeyError:
+            raise ValueError(value)
+
     def pack(self, s):
+        codec = self.bulk_codec()
+        if codec is not None:
+            if self.fields is None:
+                bulk = self.bulk
+            else:
+                bulk = make_bulk(codec, [f.data for f in self.fields])
+            pack_bulk(s, codec, bulk)
+            return
         for f in self:
             f.pack(s)
 
     @property
     def data(self):
-        return [f.data for f in self]
+        # the view is shared between reads, don't modify it
+        cached = self.cached
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        current = generation
+        if self.fields is None:
+            codec = self.element_codec
+            if codec.single:
+                data = self.bulk.tolist()
+            else:
+                values = self.bulk.tolist()
+                count = codec.count
+                data = [tuple(values[i:i + count]) for i in range(0, len(values), count)]
+        else:
+            data = [f.data for f in self.fields]
+        self.cached = (current, data)
+        return data
 
     @data.setter
     def data(self, v):
-        self.field = [self.field_fun(i, self) for i in range(len(v))]
+        codec = self.bulk_codec()
+        self.indexes = None
+        data_changed()
+        # float32 elements keep the assigned values until they are packed
+        if codec is not None and codec.typecode != "f":
+            self.fields = None
+            self.bulk = make_bulk(codec, v)
+            return
+        self.field = self.make_fields(len(v))
         for f, fv in zip(self.field, v):
             f.data = fv
 
     def serialize(self):
+        if self.fields is None:
+            return self.data
         return [f.serialize() for f in self]
 
     def append_data(self, v):
-        f = self.field_fun(len(self.field), self)
-        self.field.append(f)
+        field = self.field
+        i = len(field)
+        if self.field_fun is None:
+            f = self.field_maker()
+        else:
+            f = self.field_fun(i, self)
+        field.append(f)
+        data_changed()
         f.data = v
+        if self.indexes is not None:
+            for key, index in self.indexes.items():
+                index.setdefault(key(f), i)
 
 class Array(BaseArray):
+    __slots__ = ("size",)
+
     def __init__(self, size, *args, **kwargs):
         self.size = size
         BaseArray.__init__(self, *args, **kwargs)
 
 class PrefixedArray(BaseArray):
+    __slots__ = ("prefix_field",)
+
     def __init__(self, prefix_field, *args, **kwargs):
         self.prefix_field = prefix_field
         BaseArray.__init__(self, *args, **kwargs)
@@ -242,6 +850,8 @@ class PrefixedArray(BaseArray):
         BaseArray.pack(self, s)
 
 class BaseBlob(BaseField):
+    __slots__ = ()
+
     def unpack_data(self, s):
         return getbytes(s, self.size)
 
@@ -249,10 +859,14 @@ class BaseBlob(BaseField):
         s.write(data)
 
 class Blob(BaseBlob):
+    __slots__ = ("size",)
+
     def __init__(self, size):
         self.size = size
 
 class PrefixedBlob(BaseBlob):
+    __slots__ = ("prefix_field",)
+
     def __init__(self, prefix_field, *args, **kwargs):
         self.prefix_field = prefix_field
         BaseBlob.__init__(self, *args, **kwargs)
@@ -271,19 +885,35 @@ class PrefixedBlob(BaseBlob):
         BaseBlob.pack(self, s)
 
 class String(BaseField):
+    __slots__ = ()
+
     def unpack_data(self, s):
-        lc = []
-        c = getbyte(s)
-        while c != b"\0":
-            lc.append(c)
-            c = getbyte(s)
-        return b"".join(lc).decode()
+        return read_string(s)
 
     def pack_data(self, s, data):
         s.write(data.encode())
         s.write(b"\0")
 
+class StringTable(PrefixedArray):
+    # PrefixedArray(prefix_field, String) decoded in one pass
+    __slots__ = ()
+
+    def __init__(self, prefix_field):
+        PrefixedArray.__init__(self, prefix_field, String)
+
+    def unpack(self, s):
+        self.prefix_field.unpack(s)
+        self.field = []
+        self.indexes = None
+        data_changed()
+        for string in read_strings(s, self.size):
+            f = String()
+            f.data = string
+            self.fields.append(f)
+
 class FixedString(BaseField):
+    __slots__ = ("size",)
+
     def __init__(self, size):
         self.size = size
 
@@ -297,6 +927,8 @@ class FixedString(BaseField):
         s.write(data)
 
 class Index(BaseField):
+    __slots__ = ("array", "index_field")
+
     def __init__(self, array, index_field):
         self.array = array
         self.index_field = index_field
@@ -307,21 +939,28 @@ class Index(BaseField):
 
     def pack_data(self, s, data):
         try:
-            index = self.array.data.index(data)
+            index = self.array.index_of(data)
         except ValueError:
             index = len(self.array)
             self.array.append_data(data)
+            note_change(s, self.array[index])
         self.index_field.data = index
         self.index_field.pack(s)
 
 class Offset(BaseField):
+    __slots__ = ()
+
     def unpack_data(self, s):
         return s.tell()
 
     def pack_data(self, s, data):
+        if data != s.tell():
+            note_change(s)
         self.data = s.tell()
 
 class Pointer(ContainerField):
+    __slots__ = ("offset", "field")
+
     def __init__(self, offset, field):
         self.offset = offset
         self.field = field
@@ -339,6 +978,8 @@ class Pointer(ContainerField):
         self.field.data = v
 
 class DataPointer(ContainerField):
+    __slots__ = ("offset_field", "field")
+
     def __init__(self, offset_field, field):
         self.offset_field = offset_field
         self.field = field
@@ -356,7 +997,79 @@ class DataPointer(ContainerField):
     def data(self, v):
         self.field.data = v
 
+class LazyField(ContainerField):
+    # the target is decoded when it is first used, the stream has to stay
+    # usable until then (unpack_file buffers do)
+    __slots__ = ("template", "cache", "s", "decoded")
+
+    def __init__(self, field, cache=True):
+        self.template = field
+        self.cache = cache
+        self.s = None
+        self.decoded = None
+
+    def target_offset(self):
+        raise NotImplementedError
+
+    @property
+    def field(self):
+        if self.decoded is not None:
+            return self.decoded
+        if self.s is None:
+            return self.template
+        if self.cache:
+            field = self.template
+        else:
+            field = copy(self.template)
+        with Seek(self.s, self.target_offset()):
+            field.unpack(self.s)
+        if self.cache:
+            self.decoded = field
+            self.s = None
+        return field
+
+    @property
+    def data(self):
+        return self.field.data
+
+    @data.setter
+    def data(self, v):
+        self.s = None
+        self.decoded = None
+        self.template.data = v
+
+class LazyPointer(LazyField):
+    __slots__ = ("offset",)
+
+    def __init__(self, offset, field, cache=True):
+        self.offset = offset
+        LazyField.__init__(self, field, cache)
+
+    def unpack(self, s):
+        self.s = s
+        self.decoded = None
+
+    def target_offset(self):
+        return self.offset
+
+class LazyDataPointer(LazyField):
+    __slots__ = ("offset_field",)
+
+    def __init__(self, offset_field, field, cache=True):
+        self.offset_field = offset_field
+        LazyField.__init__(self, field, cache)
+
+    def unpack(self, s):
+        self.offset_field.unpack(s)
+        self.s = s
+        self.decoded = None
+
+    def target_offset(self):
+        return self.offset_field.data
+
 class Mapping(BaseField):
+    __slots__ = ("field", "mapping")
+
     def __init__(self, field, mapping):
         self.field = field
         self.mapping = mapping
@@ -366,6 +1079,8 @@ class Mapping(BaseField):
         return self.mapping[data]
 
 class Flags(BaseField):
+    __slots__ = ("field", "flags")
+
     def __init__(self, field, flags):
         self.field = field
         self.flags = flags
@@ -377,3 +1092,98 @@ class Flags(BaseField):
             if mask & data:
                 flag_data.append(name)
         return flag_data
+
+class Profiler(object):
+    # counts, bytes and time of unpack and pack per field class,
+    # the methods are only wrapped while the profiler is enabled
+    def __init__(self):
+        # (operation, class name) -> [calls, bytes, total time, own time]
+        self.stats = {}
+        self.stack = []
+        self.originals = []
+
+    def field_classes(self):
+        classes = []
+        todo = [BaseField]
+        while todo:
+            cls = todo.pop()
+            classes.append(cls)
+            todo.extend(cls.__subclasses__())
+        return classes
+
+    def enable(self):
+        assert not self.originals
+        for cls in self.field_classes():
+            for name in ["unpack", "pack"]:
+                method = cls.__dict__.get(name)
+                if method is not None:
+                    self.originals.append((cls, name, method))
+                    setattr(cls, name, self.wrap(name, method))
+
+    def disable(self):
+        for cls, name, method in self.originals:
+            setattr(cls, name, method)
+        self.originals = []
+
+    def wrap(self, name, method):
+        stats = self.stats
+        stack = self.stack
+        def wrapper(field, s):
+            if stack and stack[-1][0] is field:
+                # a base class method called by the field itself
+                return method(field, s)
+            frame = [field, 0.0]
+            stack.append(frame)
+            pos = s.tell()
+            start = perf_counter()
+            try:
+                return method(field, s)
+            finally:
+                elapsed = perf_counter() - start
+                stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+                key = (name, type(field).__name__)
+                entry = stats.get(key)
+                if entry is None:
+                    entry = stats[key] = [0, 0, 0.0, 0.0]
+                entry[0] += 1
+                entry[1] += s.tell() - pos
+                entry[2] += elapsed
+                entry[3] += elapsed - frame[1]
+        return wrapper
+
+    def report(self):
+        rows = []
+        for (name, cls), (calls, size, total, own) in self.stats.items():
+            rows.append({"operation": name, "class": cls, "calls": calls, "bytes": size, "time": total, "own_time": own})
+        rows.sort(key=lambda row: row["own_time"], reverse=True)
+        return rows
+
+    def dump(self, s):
+        s.write("{:<8} {:<28} {:>10} {:>12} {:>10} {:>10}\n".format("", "class", "calls", "bytes", "time", "own time"))
+        for row in self.report():
+            s.write("{operation:<8} {class:<28} {calls:>10} {bytes:>12} {time:>10.3f} {own_time:>10.3f}\n".format(**row))
+
+    def dump_json(self, s):
+        json.dump(self.report(), s, indent=4)
+
+def profile_from_environ():
+    # BINARY_PROFILE=1 prints a report to stderr at exit, a file name ending
+    # in .json gets the report as JSON, any other file name as text
+    target = environ.get("BINARY_PROFILE")
+    if not target:
+        return None
+    profiler = Profiler()
+    profiler.enable()
+    def dump():
+        if target == "1":
+            profiler.dump(stderr)
+        else:
+            with open(target, "w") as s:
+                if target.endswith(".json"):
+                    profiler.dump_json(s)
+                else:
+                    profiler.dump(s)
+    register(dump)
+    return profiler
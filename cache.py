@@ -0,0 +1,202 @@
+# Copyright (c) 2014 Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from vdf import parse
+from mdl import open_mdl
+from pcf import PCF, PCFScan
+from binary import map_file, unpack_file
+from lru import LRUCache
+from hashlib import sha1
+from io import BytesIO, TextIOWrapper
+from os import listdir, makedirs, remove, replace, stat
+from os.path import abspath, dirname, exists, join
+from pickle import Pickler, Unpickler, HIGHEST_PROTOCOL
+from re import match
+
+def file_identity(path):
+    st = stat(path)
+    return (st.st_size, st.st_mtime_ns)
+
+def content_hash(data):
+    return sha1(data).hexdigest()
+
+# entry files used in this run, prune_file_cache removes the others
+used_entry_files = set()
+
+class FileCache(object):
+    # name is a family name followed by a version number, like vdf2
+    def __init__(self, cache_dir, name):
+        self.cache_dir = cache_dir
+        self.name = name
+
+    def entry_file(self, path, key):
+        entry = content_hash("{}\0{}".format(abspath(path), key).encode())
+        return join(self.cache_dir, "{}-{}.pickle".format(self.name, entry))
+
+    def write_entry(self, entry_file, header, payload):
+        if not exists(self.cache_dir):
+            makedirs(self.cache_dir)
+        tmp_file = entry_file + ".tmp"
+        with open(tmp_file, "wb") as s:
+            Pickler(s, HIGHEST_PROTOCOL).dump(header)
+            s.write(payload)
+        replace(tmp_file, entry_file)
+
+    def get(self, path, compute, key=""):
+        # entries are keyed by path and key and validated by size, mtime and content hash
+        # a stale entry is replaced by the newly computed value
+        identity = file_identity(path)
+        entry_file = self.entry_file(path, key)
+        used_entry_files.add(entry_file)
+        header = None
+        if exists(entry_file):
+            with open(entry_file, "rb") as s:
+                entry = BytesIO(s.read())
+            header = Unpickler(entry).load()
+            if header[0] == identity:
+                return Unpickler(entry).load()
+
+        with open(path, "rb") as s:
+            data = s.read()
+        data_hash = content_hash(data)
+        if header is not None and header[1] == data_hash:
+            payload = entry.read()
+            self.write_entry(entry_file, (identity, data_hash), payload)
+            return Unpickler(BytesIO(payload)).load()
+
+        value = compute(data)
+        payload = BytesIO()
+        Pickler(payload, HIGHEST_PROTOCOL).dump(value)
+        self.write_entry(entry_file, (identity, data_hash), payload.getvalue())
+        return value
+
+def prune_file_cache(cache_dir, family):
+    # removes the entries of every version of a FileCache family that weren't
+    # used in this run: other versions, other keys and files that are gone
+    if not exists(cache_dir):
+        return
+    for filename in listdir(cache_dir):
+        if not match(r"{}\d+-[0-9a-f]{{40}}\.pickle(\.tmp)?$".format(family), filename):
+            continue
+        entry_file = join(cache_dir, filename)
+        if entry_file not in used_entry_files:
+            remove(entry_file)
+
+def prune_index_files(cache_dir, family, name):
+    # removes the index files of the other versions of a FileIndex family
+    if not exists(cache_dir):
+        return
+    for filename in listdir(cache_dir):
+        if match(r"{}\d+\.pickle(\.tmp)?$".format(family), filename) and filename != name + ".pickle":
+            remove(join(cache_dir, filename))
+
+class FileIndex(object):
+    # one file with a small value for each of many source files, entries are
+    # validated by size, mtime and content hash like in FileCache
+    def __init__(self, cache_dir, name):
+        if cache_dir is None:
+            self.index_file = None
+        else:
+            self.index_file = join(cache_dir, "{}.pickle".format(name))
+        # absolute path -> (identity, content hash, value)
+        self.entries = {}
+        self.used = set()
+        self.changed = False
+        if self.index_file is not None and exists(self.index_file):
+            with open(self.index_file, "rb") as s:
+                self.entries = Unpickler(s).load()
+
+    def get(self, path, compute):
+        path = abspath(path)
+        self.used.add(path)
+        identity = file_identity(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == identity:
+            return entry[2]
+
+        with open(path, "rb") as s:
+            data = s.read()
+        data_hash = content_hash(data)
+        if entry is not None and entry[1] == data_hash:
+            value = entry[2]
+        else:
+            value = compute(data)
+        self.entries[path] = (identity, data_hash, value)
+        self.changed = True
+        return value
+
+    def prune(self):
+        # drops the entries that weren't looked up since the index was loaded
+        for path in list(self.entries):
+            if path not in self.used:
+                del self.entries[path]
+                self.changed = True
+
+    def save(self):
+        if self.index_file is None or not self.changed:
+            return
+        cache_dir = dirname(self.index_file)
+        if not exists(cache_dir):
+            makedirs(cache_dir)
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "wb") as s:
+            Pickler(s, HIGHEST_PROTOCOL).dump(self.entries)
+        replace(tmp_file, self.index_file)
+        self.changed = False
+
+class ModelCache(LRUCache):
+    # models are shared, callers must not modify them
+    def get_model(self, path):
+        path = abspath(path)
+        return self.get((path, file_identity(path)), lambda: open_mdl(path))
+
+class PCFCache(LRUCache):
+    # decoded PCFs are shared, callers copy out of them
+    def get_pcf(self, path):
+        path = abspath(path)
+        return self.get((path, file_identity(path)), lambda: self.decode(path))
+
+    def decode(self, path):
+        pcf = unpack_file(PCF(), path)
+        # name -> first particle system definition with that name
+        systems = {}
+        for e in pcf["elements"]:
+            if e["type"].data == "DmeParticleSystemDefinition":
+                systems.setdefault(e["name"].data, e)
+        return pcf, systems
+
+    def get_system(self, path, name):
+        pcf, systems = self.get_pcf(path)
+        return systems.get(name)
+
+class PCFScanCache(LRUCache):
+    # PCFs scanned for splicing, shared like PCFCache
+    def get_pcf(self, path):
+        path = abspath(path)
+        return self.get((path, file_identity(path)), lambda: PCFScan(map_file(path).data))
+
+def decode_text(data):
+    # same decoding and newline handling as open(path, "rt")
+    return TextIOWrapper(BytesIO(data)).read()
+
+# bump when the pickled form of KVList changes
+vdf_cache_version = 2
+
+def prune_vdf_cache(cache_dir):
+    prune_file_cache(cache_dir, "vdf")
+
+def load_vdf(path, cache_dir=None, fix=None, paths=None):
+    def compute(data):
+        text = decode_text(data)
+        if fix is not None:
+            text = fix(text)
+        return parse(text, paths)
+
+    if cache_dir is None:
+        with open(path, "rb") as s:
+            return compute(s.read())
+    cache = FileCache(cache_dir, "vdf{}".format(vdf_cache_version))
+    key = fix.__name__ if fix is not None else ""
+    if paths is not None:
+        key += "\0" + "\0".join(paths)
+    return cache.get(path, compute, key)
@@ -6,44 +6,82 @@ from collections import MutableMapping
 class KVList(MutableMapping):
     def __init__(self, *args, **kwargs):
         self.list = []
-        self.update(*args, **kwargs)
+        # key -> position of its last entry, and positions of earlier duplicates
+        self.index = {}
+        self.earlier = None
+        self.deleted = 0
+        if args or kwargs:
+            self.update(*args, **kwargs)
 
     def last_index(self, key):
-        l = len(self.list)
-        for i in range(l):
-            if self.list[l-i-1][0] == key:
-                return l-i-1
-        return None
+        return self.index.get(key)
 
     def __getitem__(self, key):
-        idx = self.last_index(key)
+        idx = self.index.get(key)
         if idx is None:
             raise KeyError(key)
         return self.list[idx][1]
 
+    def get(self, key, default=None):
+        idx = self.index.get(key)
+        if idx is None:
+            return default
+        return self.list[idx][1]
+
+    def __contains__(self, key):
+        return key in self.index
+
     def __setitem__(self, key, value):
+        idx = self.index.get(key)
+        if idx is not None:
+            if self.earlier is None:
+                self.earlier = {}
+            self.earlier.setdefault(key, []).append(idx)
+        self.index[key] = len(self.list)
         self.list.append((key, value))
 
     def __delitem__(self, key):
-        idx = self.last_index(key)
+        idx = self.index.get(key)
         if idx is None:
             raise KeyError(key)
-        del self.list[idx]
+        self.list[idx] = None
+        self.deleted += 1
+        earlier = self.earlier and self.earlier.get(key)
+        if earlier:
+            self.index[key] = earlier.pop()
+            if not earlier:
+                del self.earlier[key]
+        else:
+            del self.index[key]
+        if self.deleted > len(self.list) // 2:
+            self.compact()
+
+    def compact(self):
+        entries = [e for e in self.list if e is not None]
+        self.list = []
+        self.index = {}
+        self.earlier = None
+        self.deleted = 0
+        for k, v in entries:
+            self[k] = v
 
     def __iter__(self):
-        for e in self.list:
-            yield e
+        if not self.deleted:
+            return iter(self.list)
+        return (e for e in self.list if e is not None)
 
     def __len__(self):
-        return len(self.list)
+        return len(self.list) - self.deleted
 
     def items(self):
         return list(self)
 
     def keys(self):
         keys = []
+        seen = set()
         for k, v in self:
-            if k not in keys:
+            if k not in seen:
+                seen.add(k)
                 keys.append(k)
         return keys
 
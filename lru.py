@@ -0,0 +1,23 @@
+# Copyright (c) 2014 Victor van den Elzen
+# Released under the Expat license, see LICENSE file for details
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
@@ -1,9 +1,15 @@
 # Copyright (c) 2013 Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from binary import Struct, Magic, Format, Offset, Seek, Array, FixedString, String, Pointer
+from binary import Struct, Magic, Format, Offset, Seek, Array, FixedString, String, Pointer, LazyPointer, map_file
+from io import BytesIO
+
+def skin_table(numskinfamilies, numskinref):
+    return Array(numskinfamilies, lambda: Array(numskinref, lambda: Format("h")))
+
+class MDLHeader(Struct):
+    __slots__ = ()
 
-class MDL(Struct):
     def fields(self):
         self.F("magic", Magic("IDST"))
         self.F("version", Format("I"))
@@ -46,14 +52,23 @@ class MDL(Struct):
         self.F("localnodeindex", Format("I"))
         self.F("localnodenameindex", Format("I"))
 
+class MDL(MDLHeader):
+    # the whole model, decoded while unpacking so the stream can be closed
+    # afterwards, MDLFile only decodes what is used
+    __slots__ = ()
+
+    def unpack(self, s):
+        MDLHeader.unpack(self, s)
+        for sequence in self["localsequence"].field:
+            sequence["activitymodifier"].field
+
+    def fields(self):
+        MDLHeader.fields(self)
+
         # pointed fields
         # self.F("localanim", Pointer(self["localanimoffset"].data, Array(self["numlocalanim"].data, LocalAnim)))
         self.F("localsequence", Pointer(self["localsequenceoffset"].data, Array(self["numlocalsequence"].data, LocalSequence)))
-        self.F("skin",
-            Pointer(self["skinindex"].data,
-                Array(self["numskinfamilies"].data,
-                    lambda: Array(self["numskinref"].data,
-                        lambda: Format("h")))))
+        self.F("skin", Pointer(self["skinindex"].data, skin_table(self["numskinfamilies"].data, self["numskinref"].data)))
 
         # rest broken due to unkown fields added
         return
@@ -89,7 +104,97 @@ class MDL(Struct):
         self.F("studiohdr2index", Format("I"))
         self.F("unused2", Format("1I"))
 
+class MDLFile(object):
+    # the fixed header of a model, sections are only decoded when asked for
+    def __init__(self, s):
+        self.s = s
+        self.header = MDLHeader()
+        self.header.unpack(s)
+        self.sections = {}
+
+    def __getitem__(self, key):
+        return self.header[key]
+
+    def section(self, name, offset, field):
+        if name not in self.sections:
+            with Seek(self.s, offset):
+                field.unpack(self.s)
+            self.sections[name] = field
+        return self.sections[name]
+
+    def skin(self):
+        return self.section("skin", self["skinindex"].data, skin_table(self["numskinfamilies"].data, self["numskinref"].data))
+
+    def sequences(self):
+        return self.section("localsequence", self["localsequenceoffset"].data, Array(self["numlocalsequence"].data, LocalSequence))
+
+    def sequence_labels(self):
+        return [sequence["labelindex"].data[1] for sequence in self.sequences()]
+
+    def activity_modifiers(self):
+        # sequence label -> names of its activity modifiers
+        modifiers = {}
+        for sequence in self.sequences():
+            modifiers[sequence["labelindex"].data[1]] = [modifier["szindex"].data[1] for modifier in sequence["activitymodifier"]]
+        return modifiers
+
+    def activity_modifier_offsets(self):
+        offsets = set()
+        for sequence in self.sequences():
+            for modifier in sequence["activitymodifier"]:
+                offsets.add(modifier["szindex"].data[0])
+        return offsets
+
+def open_mdl(path):
+    return MDLFile(map_file(path))
+
+class MDLPatch(object):
+    # edits to a model, checked against its parsed offsets and written out
+    # together with the rest of the file
+    def __init__(self, model, modifier_offsets=None):
+        self.model = model
+        # offset -> replacement bytes
+        self.edits = {}
+        self.munged = set()
+        # activity modifier name offsets, if the caller already scanned the sequences
+        self.modifier_offsets = modifier_offsets
+
+    def add(self, offset, data):
+        end = offset + len(data)
+        assert end <= self.model.s.size, (offset, len(data))
+        for other, other_data in self.edits.items():
+            assert end <= other or other + len(other_data) <= offset, (offset, other)
+        self.edits[offset] = data
+
+    def mung_activity_modifier(self, offset):
+        # overwrite the first character of an activity modifier name
+        if self.modifier_offsets is None:
+            self.modifier_offsets = self.model.activity_modifier_offsets()
+        assert offset in self.modifier_offsets, offset
+        if offset not in self.munged:
+            self.add(offset, b"X")
+            self.munged.add(offset)
+
+    def set_skin(self, skin):
+        s = BytesIO()
+        skin.pack(s)
+        data = s.getvalue()
+        assert len(data) == self.model["numskinfamilies"].data * self.model["numskinref"].data * 2
+        self.add(self.model["skinindex"].data, data)
+
+    def write(self, source, dest):
+        with open(source, "rb") as s:
+            image = bytearray(s.read())
+        for offset in self.munged:
+            assert image[offset:offset + 1] not in [b"X", b""]
+        for offset, data in self.edits.items():
+            image[offset:offset + len(data)] = data
+        with open(dest, "wb") as s:
+            s.write(image)
+
 class BasePointer(Format):
+    __slots__ = ()
+
     def __init__(self, fmt):
         Format.__init__(self, fmt)
 
@@ -105,12 +210,14 @@ class BasePointer(Format):
         Format.pack(self, s)
 
 class Relative(Format):
+    __slots__ = ("field",)
+
     def __init__(self, field, fmt):
         self.field = field
         Format.__init__(self, fmt)
 
-    def unpack_data(self, s):
-        data = Format.unpack_data(self, s)
+    def convert(self, data):
+        data = Format.convert(self, data)
         if data != 0:
             data += self.field.data
         return data
@@ -121,6 +228,8 @@ class Relative(Format):
         Format.pack_data(self, s, data)
 
 class RelativeString(Relative):
+    __slots__ = ()
+
     def unpack_data(self, s):
         data = Relative.unpack_data(self, s)
         with Seek(s, data):
@@ -132,6 +241,8 @@ class RelativeString(Relative):
         Relative.pack_data(self, s, data)
 
 class LocalAnim(Struct):
+    __slots__ = ()
+
     def fields(self):
         base = self.F("base", Offset())
         self.F("baseptr", BasePointer("i"))
@@ -157,6 +268,8 @@ class LocalAnim(Struct):
         self.F("zeroframestalltime", Format("f"))
 
 class LocalSequence(Struct):
+    __slots__ = ()
+
     def fields(self):
         base = self.F("base", Offset())
         self.F("baseptr", BasePointer("i"))
@@ -202,14 +315,18 @@ class LocalSequence(Struct):
         self.F("unused", Format("5I"))
 
         # self.F("event", Pointer(self["eventindex"].data, Array(self["numevents"].data, Event)))
-        self.F("activitymodifier", Pointer(self["activitymodifierindex"].data, Array(self["numactivitymodifier"].data, ActivityModifier)))
+        self.F("activitymodifier", LazyPointer(self["activitymodifierindex"].data, Array(self["numactivitymodifier"].data, ActivityModifier)))
 
 class ActivityModifier(Struct):
+    __slots__ = ()
+
     def fields(self):
         base = self.F("base", Offset())
         self.F("szindex", RelativeString(base, "i"))
 
 class Event(Struct):
+    __slots__ = ()
+
     def fields(self):
         base = self.F("base", Offset())
         self.F("cycle", Format("f"))
@@ -1,20 +1,21 @@
 # Copyright (c) 2013 Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from vdf import load, dump
+from vdf import dump
+from cache import load_vdf, prune_vdf_cache, prune_index_files, ModelCache, FileIndex, PCFCache, PCFScanCache
 from os.path import abspath, exists, dirname, join
 from sys import argv, stdout, stderr, version
 from shutil import copyfile
-from os import makedirs, listdir, name as os_name
+from os import makedirs, listdir, environ, name as os_name
 from kvlist import KVList
-from mdl import MDL
-from pcf import PCF
-from socket import parse_socket_value
+from mdl import skin_table, MDLPatch
+from pcf import PCF, scan_elements, splice_systems
+from sockets import parse_socket_value
 from wave import open as wave_open
 from collections import OrderedDict
-from io import StringIO
-from itertools import chain
-from binary import FakeWriteStream
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor
+from binary import FakeWriteStream, unpack_file, profile_from_environ
 from random import randint, seed
 
 def header(s):
@@ -26,10 +27,25 @@ def dota_file(p):
 def nohats_file(p):
     return join(nohats_dir, p)
 
+def load_dota_vdf(p, fix=None, paths=None):
+    return load_vdf(dota_file(p), cache_dir, fix, paths)
+
+models = ModelCache(64)
+particle_sources = PCFCache(16)
+particle_scans = PCFScanCache(16)
+
+def load_model(p):
+    return models.get_model(dota_file(p))
+
 def nohats():
     header("Loading items_game.txt")
-    with open(dota_file("scripts/items/items_game.txt"), "rt") as input:
-        d = load(input)
+    d = load_dota_vdf("scripts/items/items_game.txt", paths=[
+        "items_game/items",
+        "items_game/prefabs",
+        "items_game/attribute_controlled_attached_particles",
+        "items_game/particle_modifiers",
+        "items_game/anim_modifiers",
+        ])
     header("Getting defaults")
     defaults = get_defaults(d)
     default_ids = set(defaults.values())
@@ -69,6 +85,12 @@ def nohats():
     visuals = fix_flying_couriers(visuals, units, flying_courier_model)
 
     assert not visuals, visuals
+    if cache_dir is not None:
+        prune_vdf_cache(cache_dir)
+    print("Parsed models: {} cache hits, {} misses".format(models.hits, models.misses))
+    print("Parsed replacement particle files: {} cache hits, {} misses".format(particle_sources.hits, particle_sources.misses))
+    if splice:
+        print("Scanned particle files: {} cache hits, {} misses".format(particle_scans.hits, particle_scans.misses))
 
 def get_attrib(d, item, key):
     v = item.get(key)
@@ -141,6 +163,21 @@ def copy(src, dest):
     if not exists(dest):
         copyfile(src, dest)
 
+def patch_model(model, patch):
+    # like copy(model, model), with the patch applied in the same write
+    print("copy '{}' to '{}'".format(model, model))
+    if nohats_dir is None:
+        return
+    dest = nohats_file(model)
+    if exists(dest):
+        src = dest
+    else:
+        src = dota_file(model)
+    dest_dir = dirname(dest)
+    if not exists(dest_dir):
+        makedirs(dest_dir)
+    patch.write(src, dest)
+
 def copy_model(src, dest):
     if src == dest:
         return
@@ -174,9 +211,7 @@ def fix_item_model(item, default_item):
     if default_item is not None:
         copy_model(default_item["model_player"], item["model_player"])
         if has_alternate_skins(item):
-            m = MDL()
-            with open(dota_file(default_item["model_player"]), "rb") as s:
-                m.unpack(s)
+            m = load_model(default_item["model_player"])
             if m["numskinfamilies"].data != 1:
                 print("Warning: model '{}' has '{}' skin families, need to fix '{}'".format(default_item["model_player"], m["numskinfamilies"].data, item["model_player"]), file=stderr)
     else:
@@ -325,8 +360,7 @@ def fix_sounds(visuals):
     sounds = KVList()
     hero_sound_dir = dota_file("scripts/game_sounds_heroes")
     for filename in listdir(hero_sound_dir):
-        with open(join(hero_sound_dir, filename), "rt") as s:
-            part_sounds = load(s)
+        part_sounds = load_vdf(join(hero_sound_dir, filename), cache_dir)
         sounds.update(list(part_sounds))
 
     # fix sound visuals
@@ -364,8 +398,7 @@ def fix_ability_icons(visuals):
 
 def get_units():
     # get unit model list
-    with open(dota_file("scripts/npc/npc_units.txt"), "rt") as input:
-        units = load(input)
+    units = load_dota_vdf("scripts/npc/npc_units.txt")
     return units
 
 def fix_summons(visuals, units):
@@ -428,8 +461,7 @@ def fix_flying_couriers(visuals, units, flying_courier_model):
     return visuals
 
 def get_npc_heroes():
-    with open(dota_file("scripts/npc/npc_heroes.txt"), "rt") as input:
-        npc_heroes = load(input)
+    npc_heroes = load_dota_vdf("scripts/npc/npc_heroes.txt")
     return npc_heroes
 
 def get_sockets(d):
@@ -440,6 +472,23 @@ def get_sockets(d):
                 sockets.append((id, parse_socket_value(attribute["value"])))
     return sockets
 
+def scan_model(model_file, ignored, item_activities):
+    # runs in a worker process when jobs > 1, only the result goes back
+    # also returns the name offsets of all activity modifiers, for MDLPatch to
+    # check the munged ones against
+    modifier_offsets = set()
+    mung_offsets = set()
+    mung_sequence_names = set()
+    model_parsed = models.get_model(model_file)
+    for sequence in model_parsed.sequences().data:
+        ignore = sequence["activitynameindex"][1] in ignored
+        for activitymodifier in sequence["activitymodifier"]:
+            modifier_offsets.add(activitymodifier["szindex"][0])
+            if not ignore and activitymodifier["szindex"][1] in item_activities:
+                mung_offsets.add(activitymodifier["szindex"][0])
+                mung_sequence_names.add(sequence["labelindex"][1])
+    return modifier_offsets, mung_offsets, mung_sequence_names
+
 def fix_animations(d, visuals, npc_heroes):
     ignored = ["ACT_DOTA_TAUNT", "ACT_DOTA_LOADOUT"]
 
@@ -454,40 +503,32 @@ def fix_animations(d, visuals, npc_heroes):
         modifier = gem["name"]
         item_activities.add(modifier)
 
+    hero_models = []
     for k, v in npc_heroes["DOTAHeroes"]:
         if k == "Version":
             continue
         model = v["Model"]
         if not exists(dota_file(model)):
             continue
+        hero_models.append(model)
 
-        mung_offsets = set()
-        mung_sequence_names = set()
-        model_parsed = MDL()
-        with open(dota_file(model), "rb") as s:
-            model_parsed.unpack(s)
-        for sequence in model_parsed.data["localsequence"]:
-            if sequence["activitynameindex"][1] in ignored:
-                continue
-            for activitymodifier in sequence["activitymodifier"]:
-                if activitymodifier["szindex"][1] in item_activities:
-                    mung_offsets.add(activitymodifier["szindex"][0])
-                    mung_sequence_names.add(sequence["labelindex"][1])
+    model_files = [dota_file(model) for model in hero_models]
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            scans = list(executor.map(scan_model, model_files, repeat(ignored), repeat(item_activities)))
+    else:
+        scans = [scan_model(model_file, ignored, item_activities) for model_file in model_files]
 
+    for model, (modifier_offsets, mung_offsets, mung_sequence_names) in zip(hero_models, scans):
         if not mung_offsets:
             continue
 
-        copy(model, model)
+        patch = MDLPatch(load_model(model), modifier_offsets)
+        for offset in mung_offsets:
+            patch.mung_activity_modifier(offset)
+        patch_model(model, patch)
         for mung_sequence_name in sorted(list(mung_sequence_names)):
             print("Munging sequence '{}'".format(mung_sequence_name))
-        if nohats_dir is None:
-            continue
-        with open(nohats_file(model), "r+b") as s:
-            for offset in mung_offsets:
-                s.seek(offset)
-                assert s.read(1) not in [b"X", b""]
-                s.seek(offset)
-                s.write(b"X")
 
     return visuals
 
@@ -586,14 +627,29 @@ def get_particle_replacements(d, defaults, visuals, sockets, default_ids):
 
     return visuals, forwarded_particle_replacements
 
+def quote_first_line(text):
+    l, _, rest = text.partition("\n")
+    return "\"" + l + "\"" + rest
+
+# bump when particle_systems changes
+particle_index_version = 1
+
+def particle_systems(data):
+    # the particle systems defined in a PCF, and the ones defined more than once
+    systems = []
+    doubles = []
+    for type, name, guid in scan_elements(data):
+        if type == "DmeParticleSystemDefinition":
+            if name not in systems:
+                systems.append(name)
+            else:
+                doubles.append(name)
+    return systems, doubles
+
 def get_particle_file_systems(d, units, npc_heroes):
     files = []
 
-    with open(dota_file("particles/particles_manifest.txt"), "rt") as s:
-        l = s.readline().rstrip("\n")
-        l = "\"" + l + "\""
-        l += s.read()
-    m = load(StringIO(l))
+    m = load_dota_vdf("particles/particles_manifest.txt", quote_first_line)
     for k, v in m["particles_manifest"]:
         assert k == "file", k
         if v.startswith("!"):
@@ -616,24 +672,114 @@ def get_particle_file_systems(d, units, npc_heroes):
         if v["file"] not in files:
             files.append(v["file"])
 
+    index_name = "particle_systems{}".format(particle_index_version)
+    index = FileIndex(cache_dir, index_name)
     particle_file_systems = {}
     for file in files:
         if not exists(dota_file(file)):
             print("Warning: referenced particle file '{}' doesn't exist.".format(file), file=stderr)
             continue
-        particle_file_systems[file] = []
-        pcf = PCF(include_attributes=False)
-        with open(dota_file(file), "rb") as s:
-            pcf.unpack(s)
-        for e in pcf["elements"]:
-            if e["type"].data == "DmeParticleSystemDefinition":
-                if e["name"].data not in particle_file_systems[file]:
-                    particle_file_systems[file].append(e["name"].data)
-                else:
-                    print("Warning: double particle system definition '{}' in '{}'".format(e["name"].data, file), file=stderr)
+        systems, doubles = index.get(dota_file(file), particle_systems)
+        particle_file_systems[file] = systems
+        for system in doubles:
+            print("Warning: double particle system definition '{}' in '{}'".format(system, file), file=stderr)
+    index.prune()
+    index.save()
+    if cache_dir is not None:
+        prune_index_files(cache_dir, "particle_systems", index_name)
 
     return particle_file_systems
 
+def splice_particle_file(path, replacements):
+    sources = OrderedDict()
+    for system, replacement in replacements.items():
+        if replacement is not None:
+            replacement_file, replacement_system, replacement_path = replacement
+            replacement = (particle_scans.get_pcf(replacement_path), replacement_system)
+        sources[system] = replacement
+    return splice_systems(particle_scans.get_pcf(path), sources)
+
+def particle_cache_counts():
+    return [(cache.hits, cache.misses) for cache in (particle_sources, particle_scans)]
+
+def particle_file_plan(file, replacements):
+    # workers started with spawn don't get the globals set under __main__, so
+    # the plan has the absolute paths, the seed and the mode
+    resolved = OrderedDict()
+    for system, replacement in replacements.items():
+        if replacement is not None:
+            replacement_file, replacement_system = replacement
+            replacement = (replacement_file, replacement_system, dota_file(replacement_file))
+        resolved[system] = replacement
+    if nohats_dir:
+        dest = nohats_file(file)
+    else:
+        dest = None
+    return (file, dota_file(file), dest, resolved, "{}:{}".format(seed_num, file), splice)
+
+def rewrite_particle_file(plan):
+    # runs in a worker process when jobs > 1, only the log and the cache
+    # counts go back. The random generator is seeded per file so the new guids
+    # don't depend on which files a worker did before
+    file, path, dest, replacements, file_seed, splice = plan
+    seed(file_seed)
+    counts = particle_cache_counts()
+    log = ["{}:".format(file)]
+    for system, replacement in replacements.items():
+        if replacement is None:
+            log.append("\t{} -> None".format(system))
+        else:
+            replacement_file, replacement_system, replacement_path = replacement
+            log.append("\t{} -> {} ({})".format(system, replacement_system, replacement_file))
+    rewrite_particle_file_data(file, path, dest, replacements, splice, log)
+    return log, [(hits - old_hits, misses - old_misses) for (hits, misses), (old_hits, old_misses) in zip(particle_cache_counts(), counts)]
+
+def rewrite_particle_file_data(file, path, dest, replacements, splice, log):
+    if dest is not None:
+        # other workers may be creating it too
+        makedirs(dirname(dest), exist_ok=True)
+
+    if splice:
+        data = splice_particle_file(path, replacements)
+        if dest is not None:
+            with open(dest, "wb") as s:
+                s.write(data)
+        log.append("\tspliced {} bytes".format(len(data)))
+        return
+
+    p = unpack_file(PCF(), path)
+    p.minimize()
+    main_element = p["elements"][0]
+    assert main_element["type"].data == "DmElement"
+    assert len(main_element.attribute) == 1
+    main_attribute = main_element.attribute[0]
+    assert main_attribute["name"].data == "particleSystemDefinitions"
+    assert main_attribute["type"].data == 15
+    psdl = main_attribute["data"]
+    copied = {}
+    for i in range(len(psdl)):
+        psd = psdl[i].data
+        assert psd["type"].data == "DmeParticleSystemDefinition"
+        name = psd["name"].data
+        if name in replacements:
+            if replacements[name] is None:
+                psd.attribute.data = []
+            else:
+                replacement_file, replacement_system, replacement_path = replacements[name]
+                e = particle_sources.get_system(replacement_path, replacement_system)
+                if e is not None:
+                    p.copy_system(psd, e, copied)
+            del replacements[name]
+    assert not replacements
+
+    if dest is not None:
+        with open(dest, "wb") as s:
+            packs, old_packs = p.full_pack(s)
+    else:
+        s = FakeWriteStream(0, file)
+        packs, old_packs = p.full_pack(s)
+    log.append("\tpacked {} times, the old packer needed {}".format(packs, old_packs))
+
 def fix_particles(d, defaults, default_ids, visuals, sockets, units, npc_heroes):
     visuals, particle_replacements = get_particle_replacements(d, defaults, visuals, sockets, default_ids)
 
@@ -670,55 +816,19 @@ def fix_particles(d, defaults, default_ids, visuals, sockets, units, npc_heroes)
                 # TODO: figure out the right choice when len(default_system_files) > 1
                 file_replacements[file][system] = (default_system_files[0], default_system)
 
-    for file, replacements in file_replacements.items():
-        print("{}:".format(file))
-        for system, replacement in replacements.items():
-            if replacement is None:
-                print("\t{} -> None".format(system))
-            else:
-                replacement_file, replacement_system = replacement
-                print("\t{} -> {} ({})".format(system, replacement_system, replacement_file))
-
-        p = PCF()
-        with open(dota_file(file), "rb") as s:
-            p.unpack(s)
-        p.minimize()
-        main_element = p["elements"][0]
-        assert main_element["type"].data == "DmElement"
-        assert len(main_element.attribute) == 1
-        main_attribute = main_element.attribute[0]
-        assert main_attribute["name"].data == "particleSystemDefinitions"
-        assert main_attribute["type"].data == 15
-        psdl = main_attribute["data"]
-        for i in range(len(psdl)):
-            psd = psdl[i].data
-            assert psd["type"].data == "DmeParticleSystemDefinition"
-            name = psd["name"].data
-            if name in replacements:
-                if replacements[name] is None:
-                    psd.attribute.data = []
-                else:
-                    replacement_file, replacement_system = replacements[name]
-                    o = PCF()
-                    with open(dota_file(replacement_file), "rb") as s:
-                        o.unpack(s)
-                    for e in o["elements"]:
-                        if e["type"].data == "DmeParticleSystemDefinition" and e["name"].data == replacement_system:
-                            psd.attribute.data = e.attribute.data
-                            break
-                del replacements[name]
-        assert not replacements
-
-        if nohats_dir:
-            dest = nohats_file(file)
-            dest_dir = dirname(dest)
-            if not exists(dest_dir):
-                makedirs(dest_dir)
-            with open(dest, "wb") as s:
-                p.full_pack(s)
-        else:
-            s = FakeWriteStream(0, file)
-            p.full_pack(s)
+    plan = [particle_file_plan(file, replacements) for file, replacements in file_replacements.items()]
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            for log, counts in executor.map(rewrite_particle_file, plan):
+                print("\n".join(log))
+                # the replacement files were read in the workers
+                for cache, (hits, misses) in zip((particle_sources, particle_scans), counts):
+                    cache.hits += hits
+                    cache.misses += misses
+    else:
+        for file_plan in plan:
+            log, _ = rewrite_particle_file(file_plan)
+            print("\n".join(log))
 
     return visuals
 
@@ -735,18 +845,14 @@ def fix_skins(courier_model, flying_courier_model):
         "models/heroes/tiny_04/tiny_04.mdl",
         ]
     for model in skins:
-        m = MDL()
-        with open(dota_file(model), "rb") as s:
-            m.unpack(s)
+        m = load_model(model)
         assert m["numskinfamilies"] != 1, (model, m["numskinfamilies"])
-        for i in range(1, m["numskinfamilies"].data):
-            m["skin"].field[i].data = m["skin"].field[0].data
-        copy(model, model)
-        if nohats_dir is None:
-            continue
-        with open(nohats_file(model), "r+b") as s:
-            s.seek(m["skinindex"].data)
-            m["skin"].field.pack(s)
+        # a new table, the cached model stays as it is
+        skin = skin_table(m["numskinfamilies"].data, m["numskinref"].data)
+        skin.data = [m.skin().data[0]] * m["numskinfamilies"].data
+        patch = MDLPatch(m)
+        patch.set_skin(skin)
+        patch_model(model, patch)
 
 if __name__ == "__main__":
     dota_dir = abspath(argv[1])
@@ -765,4 +871,15 @@ if __name__ == "__main__":
     if nohats_dir is not None:
         nohats_dir = abspath(nohats_dir)
         assert not exists(nohats_dir)
+    cache_dir = environ.get("NOHATS_CACHE", "nohats_cache")
+    if cache_dir:
+        cache_dir = abspath(cache_dir)
+    else:
+        cache_dir = None
+    jobs = int(environ.get("NOHATS_JOBS", "1"))
+    splice = bool(int(environ.get("NOHATS_SPLICE", "0")))
+    if profile_from_environ() is not None and jobs > 1:
+        # the profiler only sees this process
+        print("Warning: BINARY_PROFILE is set, ignoring NOHATS_JOBS={}".format(jobs), file=stderr)
+        jobs = 1
     nohats()
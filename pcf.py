@@ -1,12 +1,15 @@
 # Copyright (c) 2013 Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from binary import Struct, Magic, Format, String, Blob, PrefixedBlob, PrefixedArray, Array, Index, FixedString, BaseField
+from binary import Struct, Magic, Format, String, StringTable, Blob, PrefixedBlob, PrefixedArray, Array, Index, FixedString, BaseField, Buffer, compile_format, getbytes, note_change
 import json
+from collections import OrderedDict
 from uuid import UUID
 from random import randint
 
 class UUIDField(Blob):
+    __slots__ = ()
+
     def __init__(self):
         Blob.__init__(self, 16)
 
@@ -17,7 +20,12 @@ class UUIDField(Blob):
     def pack_data(self, s, data):
         Blob.pack_data(self, s, UUID(data).bytes)
 
+def element_guid(element):
+    return element["guid"].data
+
 class ElementIndex(BaseField):
+    __slots__ = ("elements", "attributes", "index_field")
+
     def __init__(self, elements, attributes, index_field):
         self.elements = elements
         self.attributes = attributes
@@ -29,13 +37,14 @@ class ElementIndex(BaseField):
 
     def pack_data(self, s, data):
         try:
-            index = self.elements.field.index(data)
+            index = self.elements.index_of(element_guid(data), element_guid)
         except ValueError:
             data.new_guid()
             index = len(self.elements)
             self.elements.append_data(data.data)
             self.attributes.append_data(data.attribute.data)
             self.elements[index].attribute = self.attributes[index]
+            note_change(s, self.elements[index])
         self.index_field.data = index
         self.index_field.pack(s)
 
@@ -43,35 +52,49 @@ class ElementIndex(BaseField):
         return self.index_field.data
 
 class Attribute(Struct):
+    __slots__ = ()
+
+    # 1 (element index) and 5 (string) depend on the file
+    attribute_types = {
+        2 : lambda: Format("I"), # integer
+        3 : lambda: Format("f"), # float
+        4 : lambda: Format("?"), # bool
+        6 : lambda: PrefixedBlob(Format("I")), # blob
+        7 : lambda: Format("I"), # time
+        8 : lambda: Format("4B"), # color
+        9 : lambda: Format("2f"), # vector2
+        10 : lambda: Format("3f"), # vector3
+        11 : lambda: Format("4f"), # vector4
+        12 : lambda: Format("3f"), # angle
+        13 : lambda: Format("4f"), # quaternion
+        14 : lambda: Format("16f"), # matrix
+    }
+
     def fields(self, namefield, stringfield, elementindexfield):
         self.F("name", namefield())
         type = self.F("type", Format("B")).data
 
-        attribute_types = {
-            1 : elementindexfield, # element index
-            2 : lambda: Format("I"), # integer
-            3 : lambda: Format("f"), # float
-            4 : lambda: Format("?"), # bool
-            5 : stringfield, # string
-            6 : lambda: PrefixedBlob(Format("I")), # blob
-            7 : lambda: Format("I"), # time
-            8 : lambda: Format("4B"), # color
-            9 : lambda: Format("2f"), # vector2
-            10 : lambda: Format("3f"), # vector3
-            11 : lambda: Format("4f"), # vector4
-            12 : lambda: Format("3f"), # angle
-            13 : lambda: Format("4f"), # quaternion
-            14 : lambda: Format("16f"), # matrix
-        }
-
         if 1 <= type <= 14:
-            self.F("data", attribute_types[type]())
+            base_type = type
         elif 14 < type <= 28:
-            self.F("data", PrefixedArray(Format("I"), attribute_types[type - 14]))
+            base_type = type - 14
         else:
             assert False, type
+        if base_type == 1:
+            field_maker = elementindexfield
+        elif base_type == 5:
+            field_maker = stringfield
+        else:
+            field_maker = self.attribute_types[base_type]
+
+        if type <= 14:
+            self.F("data", field_maker())
+        else:
+            self.F("data", PrefixedArray(Format("I"), field_maker))
 
 class Element(Struct):
+    __slots__ = ("attribute",)
+
     def fields(self, namefield, stringfield):
         self.F("type", namefield())
         self.F("name", stringfield())
@@ -81,11 +104,15 @@ class Element(Struct):
         return isinstance(other, Element) and self["guid"].data == other["guid"].data
 
     def new_guid(self):
-        random_bytes = bytes([randint(0, 255) for i in range(16)])
-        uuid = UUID(bytes=random_bytes, version=4)
-        self["guid"].data = uuid.urn
+        self["guid"].data = random_guid().urn
+
+def random_guid():
+    random_bytes = bytes([randint(0, 255) for i in range(16)])
+    return UUID(bytes=random_bytes, version=4)
 
 class PCF(Struct):
+    __slots__ = ()
+
     def fields(self, include_attributes=True):
         self.F("magic", Magic("<!-- dmx encoding "))
         self.F("version", FixedString(len("binary 2 format pcf 1")))
@@ -97,7 +124,7 @@ class PCF(Struct):
             prefix = Format("h")
         else:
             prefix = Format("I")
-        strings = self.F("strings", PrefixedArray(prefix, String))
+        strings = self.F("strings", StringTable(prefix))
 
         if version == "binary 2 format pcf 1":
             namefield = lambda: Index(strings, Format("h"))
@@ -107,14 +134,10 @@ class PCF(Struct):
             stringfield = namefield
         self.F("elements", PrefixedArray(Format("I"), lambda: Element(namefield, stringfield)))
         if include_attributes:
-            self.F("attributes",
-                Array(len(self["elements"]),
-                    field_function=lambda i, f: PrefixedArray(
-                        Format("I"),
-                        lambda: Attribute(
-                            namefield,
-                            stringfield,
-                            lambda: ElementIndex(self["elements"], f, Format("I"))))))
+            def attribute_list(i, f):
+                elementindexfield = lambda: ElementIndex(self["elements"], f, Format("I"))
+                return PrefixedArray(Format("I"), lambda: Attribute(namefield, stringfield, elementindexfield))
+            self.F("attributes", Array(len(self["elements"]), field_function=attribute_list))
             for i in range(len(self["elements"])):
                 self["elements"][i].attribute = self["attributes"][i]
 
@@ -123,3 +146,302 @@ class PCF(Struct):
         self["elements"].data = [self["elements"].data[0]]
         self["attributes"].data = [self["attributes"].data[0]]
         self["elements"][0].attribute = self["attributes"][0]
+
+    def copy_system(self, psd, system, copied=None):
+        # give psd, an element of this PCF, the attributes of system, an element
+        # of another PCF. The elements reachable from system that this PCF
+        # doesn't have yet are copied in once, copied maps their guids to
+        # (source element, copy) and can be shared between calls
+        if copied is None:
+            copied = {}
+        elements = self["elements"]
+
+        def target(e):
+            if e is system:
+                return psd
+            return copied[element_guid(e)][1]
+
+        new = []
+        queue = [system]
+        for e in queue:
+            for ref in referenced_elements(e):
+                if ref is system:
+                    continue
+                guid = element_guid(ref)
+                entry = copied.get(guid)
+                if entry is not None and entry[0] is ref:
+                    continue
+                try:
+                    copied[guid] = (ref, elements[elements.index_of(guid, element_guid)])
+                except ValueError:
+                    copied[guid] = (ref, None)
+                    new.append(ref)
+                    queue.append(ref)
+
+        for e in new:
+            # the new guid goes in before appending, index_of keys on it
+            data = OrderedDict(e.data)
+            data["guid"] = random_guid().urn
+            elements.append_data(data)
+            copied[element_guid(e)] = (e, elements[len(elements) - 1])
+        attributes = self["attributes"]
+        for e in new:
+            copy = target(e)
+            attributes.append_data(copied_attributes(e, target))
+            copy.attribute = attributes[len(attributes) - 1]
+        psd.attribute.data = copied_attributes(system, target)
+
+def referenced_elements(e):
+    for attribute in e.attribute:
+        type = attribute["type"].data
+        if type == 1:
+            yield attribute["data"].data
+        elif type == 15:
+            for ref in attribute["data"].data:
+                yield ref
+
+def copied_attributes(e, target):
+    data = []
+    for attribute in e.attribute:
+        type = attribute["type"].data
+        value = attribute["data"].data
+        if type == 1:
+            value = target(value)
+        elif type == 15:
+            value = [target(ref) for ref in value]
+        data.append(OrderedDict([("name", attribute["name"].data), ("type", type), ("data", value)]))
+    return data
+
+pcf_versions = {
+    # version: (string count and index format, inline element names)
+    "binary 2 format pcf 1": ("h", True),
+    "binary 5 format pcf 2": ("I", False),
+}
+
+def read_element_table(s):
+    # the version, strings and (type, name, guid bytes) of every element of
+    # the PCF in Buffer s, leaves s at the first attribute list
+    assert s.read(len("<!-- dmx encoding ")) == b"<!-- dmx encoding "
+    version = s.read(len("binary 2 format pcf 1")).decode()
+    assert s.read(len(" -->\n\0")) == b" -->\n\0"
+    assert version in pcf_versions, version
+    index_format, inline_names = pcf_versions[version]
+    index = compile_format("<" + index_format)
+
+    strings = s.read_strings(s.unpack(index)[0])
+    count = s.unpack(compile_format("<I"))[0]
+    elements = []
+    if inline_names:
+        for i in range(count):
+            type = strings[s.unpack(index)[0]]
+            name = s.read_strings(1)[0]
+            elements.append((type, name, getbytes(s, 16)))
+    else:
+        record = compile_format("<" + index_format * 2 + "16s")
+        for i in range(count):
+            type, name, guid = s.unpack(record)
+            elements.append((strings[type], strings[name], guid))
+    return version, strings, elements
+
+def scan_elements(data):
+    # (type, name, guid) of every element, read from the file data without
+    # decoding it into fields
+    version, strings, elements = read_element_table(Buffer(data))
+    return [(type, name, UUID(bytes=guid).urn) for type, name, guid in elements]
+
+# sizes of the attribute types with a fixed size
+attribute_sizes = {2: 4, 3: 4, 4: 1, 7: 4, 8: 4, 9: 8, 10: 12, 11: 16, 12: 12, 13: 16, 14: 64}
+
+class PCFScan(object):
+    # the element table of a PCF and the byte ranges of the attribute lists,
+    # with the positions of the string and element indices in them, so they
+    # can be copied into another file without decoding the attributes
+    def __init__(self, data):
+        s = Buffer(data)
+        version, self.strings, self.elements = read_element_table(s)
+        index_format, inline_names = pcf_versions[version]
+        self.data = data
+        self.version = version
+        self.inline_names = inline_names
+        self.index = index = compile_format("<" + index_format)
+        uint = compile_format("<I")
+        byte = compile_format("<B")
+
+        # (start, end) of every attribute list and the (offset, kind, value) of
+        # the attribute names ("n", string index), string values ("s", string
+        # index, or "i" for inline strings) and element indices ("e") in it
+        self.blocks = []
+        self.refs = []
+        for i in range(len(self.elements)):
+            start = s.pos
+            refs = []
+            for j in range(s.unpack(uint)[0]):
+                refs.append((s.pos, "n", s.unpack(index)[0]))
+                type = s.unpack(byte)[0]
+                assert 1 <= type <= 28, type
+                if type <= 14:
+                    n = 1
+                else:
+                    type -= 14
+                    n = s.unpack(uint)[0]
+                if type == 1:
+                    for k in range(n):
+                        refs.append((s.pos, "e", s.unpack(uint)[0]))
+                elif type == 5 and inline_names:
+                    for k in range(n):
+                        refs.append((s.pos, "i", s.read_strings(1)[0]))
+                elif type == 5:
+                    for k in range(n):
+                        refs.append((s.pos, "s", s.unpack(index)[0]))
+                elif type == 6:
+                    for k in range(n):
+                        s.view(s.unpack(uint)[0])
+                else:
+                    s.view(attribute_sizes[type] * n)
+            self.blocks.append((start, s.pos))
+            self.refs.append(refs)
+
+        # name -> first particle system definition with that name
+        self.systems = {}
+        for i, (type, name, guid) in enumerate(self.elements):
+            if type == "DmeParticleSystemDefinition":
+                self.systems.setdefault(name, i)
+
+    def element_refs(self, i):
+        return [index for offset, kind, index in self.refs[i] if kind == "e"]
+
+    def block(self, i, target, strings, elements):
+        # the attribute list of element i encoded for the target PCF, strings
+        # gives the new index of a string, None keeps the string indices and
+        # is only for blocks of the target itself
+        uint = compile_format("<I")
+        data = self.data
+        chunks = []
+        pos, end = self.blocks[i]
+        for offset, kind, value in self.refs[i]:
+            if kind == "e":
+                chunks.append(data[pos:offset])
+                chunks.append(uint.pack(elements(value)))
+                pos = offset + uint.size
+            elif strings is None:
+                continue
+            elif kind == "n":
+                chunks.append(data[pos:offset])
+                chunks.append(target.index.pack(strings(self.strings[value])))
+                pos = offset + self.index.size
+            elif kind == "s":
+                chunks.append(data[pos:offset])
+                if target.inline_names:
+                    chunks.append(self.strings[value].encode() + b"\0")
+                else:
+                    chunks.append(target.index.pack(strings(self.strings[value])))
+                pos = offset + self.index.size
+            elif not target.inline_names:
+                chunks.append(data[pos:offset])
+                chunks.append(target.index.pack(strings(value)))
+                pos = offset + len(value.encode()) + 1
+        chunks.append(data[pos:end])
+        return chunks
+
+def splice_systems(target, replacements):
+    # the same file as minimize and copy_system on the decoded target give,
+    # but the attribute lists of the remaining elements are copied as bytes.
+    # replacements maps system names to None (no attributes) or to (source
+    # PCFScan, system name), systems missing from their source stay as they
+    # are. Sources can have another version than the target
+    uint = compile_format("<I")
+    replacements = dict(replacements)
+    assert target.elements[0][0] == "DmElement"
+    root_refs = target.refs[0]
+    start, end = target.blocks[0]
+    assert uint.unpack_from(target.data, start)[0] == 1
+    name_offset, kind, name = root_refs[0]
+    assert target.strings[name] == "particleSystemDefinitions"
+    assert target.data[name_offset + target.index.size] == 15
+
+    replaced = OrderedDict()
+    for i in target.element_refs(0):
+        type, name, guid = target.elements[i]
+        assert type == "DmeParticleSystemDefinition"
+        if name in replacements:
+            replacement = replacements.pop(name)
+            if replacement is None:
+                replaced[i] = None
+            else:
+                source, system = replacement
+                j = source.systems.get(system)
+                if j is not None:
+                    replaced[i] = (source, j)
+    assert not replacements
+
+    # the elements of the target that are still reachable keep their order
+    reachable = set([0])
+    queue = [0]
+    for i in queue:
+        if i in replaced:
+            continue
+        for ref in target.element_refs(i):
+            if ref not in reachable:
+                reachable.add(ref)
+                queue.append(ref)
+    kept = sorted(reachable)
+    new_index = dict((i, n) for n, i in enumerate(kept))
+
+    # (source, element) -> index of its copy, shared like in copy_system
+    copied = {}
+    # (source, element, system, index of the element the system was copied to)
+    copies = []
+    for i, replacement in replaced.items():
+        if replacement is None:
+            continue
+        source, system = replacement
+        queue = [system]
+        for e in queue:
+            for ref in source.element_refs(e):
+                if ref == system or (source, ref) in copied:
+                    continue
+                copied[(source, ref)] = len(kept) + len(copies)
+                copies.append((source, ref, system, new_index[i]))
+                queue.append(ref)
+
+    strings = list(target.strings)
+    string_index = {}
+    for n, string in reversed(list(enumerate(strings))):
+        string_index[string] = n
+    def add_string(string):
+        n = string_index.get(string)
+        if n is None:
+            n = len(strings)
+            strings.append(string)
+            string_index[string] = n
+        return n
+    def source_elements(source, system, psd):
+        return lambda index: psd if index == system else copied[(source, index)]
+
+    blocks = []
+    for i in kept:
+        replacement = replaced.get(i, False)
+        if replacement is False:
+            blocks.extend(target.block(i, target, None, new_index.__getitem__))
+        elif replacement is None:
+            blocks.append(uint.pack(0))
+        else:
+            source, system = replacement
+            blocks.extend(source.block(system, target, add_string, source_elements(source, system, new_index[i])))
+    for source, e, system, psd in copies:
+        blocks.extend(source.block(e, target, add_string, source_elements(source, system, psd)))
+
+    elements = [target.elements[i] for i in kept]
+    elements += [source.elements[e][:2] + (random_guid().bytes,) for source, e, system, psd in copies]
+    table = []
+    if target.inline_names:
+        for type, name, guid in elements:
+            table.append(target.index.pack(add_string(type)) + name.encode() + b"\0" + guid)
+    else:
+        for type, name, guid in elements:
+            table.append(target.index.pack(add_string(type)) + target.index.pack(add_string(name)) + guid)
+
+    header = [b"<!-- dmx encoding ", target.version.encode(), b" -->\n\0", target.index.pack(len(strings))]
+    header += [string.encode() + b"\0" for string in strings]
+    header.append(uint.pack(len(elements)))
+    return b"".join(header + table + blocks)
@@ -2,6 +2,12 @@
 # Released under the Expat license, see LICENSE file for details
 
 from kvlist import KVList
+import re
+
+# whitespace and comments, then a quoted string, another character or EOF
+token_re = re.compile(r'(?:\s+|/[^\n]*(?:\n|\Z))*(?:"([^"]*)(")|(\S)|\Z)')
+# everything up to the next brace
+skip_re = re.compile(r'(?:[^{}"/]+|"[^"]*"|/[^\n]*)*(.?)', re.S)
 
 def skip_space(s):
     while True:
@@ -25,7 +31,106 @@ def getstring(s):
         lc.append(c)
     return "".join(lc)
 
-def load(s):
+def load(s, paths=None):
+    return parse(s.read(), paths)
+
+def path_tree(paths):
+    # {key: subtree}, where a subtree of None selects everything below the key
+    if paths is None:
+        return None
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split("/")
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+            if node is None:
+                break
+        else:
+            node[keys[-1]] = None
+    return tree
+
+def skip_dict(text, pos, context):
+    depth = 1
+    match = skip_re.match
+    while depth:
+        m = match(text, pos)
+        pos = m.end()
+        c = m.group(1)
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+        elif c == '"':
+            assert False, "unexpected EOF"
+        else:
+            assert False, "Expected '\"' or '}}', got '' in {}".format(context)
+    return pos
+
+def parse(text, paths=None):
+    items = KVList()
+    stack = []
+    d = items
+    context = []
+    select = path_tree(paths)
+    selects = []
+    k = None
+    pos = 0
+    while pos is not None:
+        tokens = token_re.finditer(text, pos)
+        pos = None
+        for m in tokens:
+            token = m.lastindex
+            if k is None:
+                if token == 2:
+                    k = m.group(1)
+                    continue
+                c = m.group(3)
+                if c == "}" and stack:
+                    d = stack.pop()
+                    context.pop()
+                    select = selects.pop()
+                elif c is None and not stack:
+                    break
+                elif c == '"':
+                    assert False, "unexpected EOF"
+                elif stack:
+                    assert False, "Expected '\"' or '}}', got '{}' in {}".format(c or "", context)
+                else:
+                    assert False, "Unexpected character '{}'".format(c)
+                continue
+
+            if select is None:
+                sub = None
+            else:
+                sub = select.get(k, False)
+            if token == 2:
+                if sub is not False:
+                    d[k] = m.group(1)
+                k = None
+                continue
+            c = m.group(3)
+            if c == "{":
+                if sub is False:
+                    # not selected, skip to the matching brace
+                    pos = skip_dict(text, m.end(), context + [k])
+                    k = None
+                    break
+                v = KVList()
+                d[k] = v
+                stack.append(d)
+                context.append(k)
+                selects.append(select)
+                select = sub
+                d = v
+                k = None
+            elif c == '"':
+                assert False, "unexpected EOF"
+            else:
+                assert False, "Expected a string or a dict, got '{}' in {}".format(c or "", repr(context))
+    return items
+
+def load_chars(s):
     items = KVList()
     while True:
         c = skip_space(s)
@@ -1,11 +1,11 @@
 # Copyright (c) 2014 Victor van den Elzen
 # Released under the Expat license, see LICENSE file for details
 
-from binary import Struct, Magic, Format, Array, String, Pointer, DataPointer, Index, PrefixedArray, BaseField, Mapping, Flags, getbytes
+from lru import LRUCache
+from binary import Struct, Magic, Format, Array, String, Pointer, DataPointer, LazyPointer, Index, PrefixedArray, BaseField, Mapping, Flags, Buffer, getbytes, getview, unpack_file, profile_from_environ
 from struct import pack
 from lzma import decompress, FORMAT_ALONE
 
-from io import BytesIO
 from itertools import chain
 from json import dump
 from os import makedirs
@@ -15,18 +15,22 @@ from sys import argv, stderr
 from zlib import crc32
 
 class LZMAField(BaseField):
+    __slots__ = ("uncompressed_size", "compressed_size")
+
     def __init__(self, uncompressed_size, compressed_size):
         self.uncompressed_size = uncompressed_size
         self.compressed_size = compressed_size
 
     def unpack_data(self, s):
         props = getbytes(s, 5)
-        data = getbytes(s, self.compressed_size)
+        data = getview(s, self.compressed_size)
         alone_data = props + pack("Q", self.uncompressed_size) + data
         unpacked = decompress(alone_data, FORMAT_ALONE)
         return unpacked
 
 class Scene(Struct):
+    __slots__ = ()
+
     def fields(self):
         self.F("method", Magic("LZMA"))
         self.F("uncompressed_size", Format("I"))
@@ -35,12 +39,16 @@ class Scene(Struct):
         self.F("scene_data", LZMAField(self["uncompressed_size"].data, self["compressed_size"].data))
 
 class SceneSummary(Struct):
+    __slots__ = ()
+
     def fields(self, strings):
         self.F("milliseconds", Format("I"))
         self.F("milliseconds_2", Format("I"))
         self.F("sounds", PrefixedArray(Format("I"), lambda: Index(strings, Format("I"))))
 
 class SceneEntry(Struct):
+    __slots__ = ()
+
     def fields(self, strings):
         self.F("namecrc", Format("I"))
         self.F("offset", Format("I"))
@@ -48,9 +56,26 @@ class SceneEntry(Struct):
         # self.F("scenesummary", Format("I"))
         self.F("scenesummary", DataPointer(Format("I"), SceneSummary(strings)))
 
-        self.F("scene", Pointer(self["offset"].data, Scene()))
+        self.F("scene", LazyPointer(self["offset"].data, Scene(), cache=False))
+
+def scene_crc(entry):
+    return entry["namecrc"].data
+
+def scene_name_crc(name):
+    return crc32(name.replace('/', '\\').encode())
 
 class VSIF(Struct):
+    # scenes are decompressed when get_scene asks for them, the last
+    # cache_size of them are kept
+    __slots__ = ("scene_cache",)
+
+    def __init__(self, cache_size=0):
+        Struct.__init__(self)
+        if cache_size:
+            self.scene_cache = LRUCache(cache_size)
+        else:
+            self.scene_cache = None
+
     def fields(self):
         self.F("magic", Magic("VSIF"))
         self.F("version", Format("I"))
@@ -62,7 +87,33 @@ class VSIF(Struct):
 
         self.F("scenes", Pointer(self["scenesoffset"].data, Array(self["nscenes"].data, lambda: SceneEntry(self["strings"]))))
 
+    def get_scene(self, crc_or_name):
+        # the decoded BVCD of a scene by name CRC or name, None if it isn't there
+        if isinstance(crc_or_name, str):
+            name = crc_or_name
+            crc = scene_name_crc(name)
+        else:
+            crc = crc_or_name
+            name = "{:08x}".format(crc)
+        try:
+            i = self["scenes"].field.index_of(crc, scene_crc)
+        except ValueError:
+            return None
+        if self.scene_cache is None:
+            return self.decode_scene(i, name)
+        return self.scene_cache.get(crc, lambda: self.decode_scene(i, name))
+
+    def decode_scene(self, i, name):
+        # name is only for the error message
+        b = BVCD(self["strings"])
+        s = Buffer(self["scenes"][i]["scene"]["scene_data"].data)
+        b.unpack(s)
+        assert s.read(1) == b"", name
+        return b
+
 class ScaledField(BaseField):
+    __slots__ = ("field", "scale")
+
     def __init__(self, field, scale):
         self.field = field
         self.scale = scale
@@ -72,16 +123,22 @@ class ScaledField(BaseField):
         return data / self.scale
 
 class BVCDTag(Struct):
+    __slots__ = ()
+
     def fields(self, strings, paramfield):
         self.F("name", Index(strings, Format("I")))
         self.F("param", paramfield)
 
 class BVCDRamp(Struct):
+    __slots__ = ()
+
     def fields(self):
         self.F("t", Format("f"))
         self.F("v", ScaledField(Format("B"), 255.))
 
 class BVCDFlexSample(Struct):
+    __slots__ = ()
+
     curve_types = [
         "default",
         "catmullrom_normalize_x",
@@ -108,6 +165,8 @@ class BVCDFlexSample(Struct):
         self.F("to_type", Mapping(Format("B"), self.curve_types))
 
 class BVCDFlexTrack(Struct):
+    __slots__ = ()
+
     flag_types = [
         (1, "disabled"),
         (2, "combo"),
@@ -122,6 +181,8 @@ class BVCDFlexTrack(Struct):
             self.F("combo_samples", PrefixedArray(Format("H"), BVCDFlexSample))
 
 class BVCDEvent(Struct):
+    __slots__ = ()
+
     event_types = [
         "unspecified",
         "section",
@@ -184,18 +245,24 @@ class BVCDEvent(Struct):
             self.F("ccflags", Flags(Format("B"), self.cc_flag_types))
 
 class BVCDChannel(Struct):
+    __slots__ = ()
+
     def fields(self, strings):
         self.F("name", Index(strings, Format("I")))
         self.F("events", PrefixedArray(Format("B"), lambda: BVCDEvent(strings)))
         self.F("disabled", Format("B"))
 
 class BVCDActors(Struct):
+    __slots__ = ()
+
     def fields(self, strings):
         self.F("name", Index(strings, Format("I")))
         self.F("channels", PrefixedArray(Format("B"), lambda: BVCDChannel(strings)))
         self.F("disabled", Format("B"))
 
 class BVCD(Struct):
+    __slots__ = ()
+
     def fields(self, strings):
         self.F("magic", Magic("bvcd"))
         self.F("version", Format("B"))
@@ -232,7 +299,7 @@ def create_crc_mapping(d, scene_list):
 
     crcs = {}
     for name in chain(names, generated_names):
-        crc = crc32(name.replace('/', '\\').encode())
+        crc = scene_name_crc(name)
         if crc in crcs:
             if crcs[crc] != name:
                 print("CRC {:x} for both '{}' and '{}'".format(crc, crcs[crc], name), file=stderr)
@@ -242,15 +309,13 @@ def create_crc_mapping(d, scene_list):
     return crcs
 
 def unpack(vsif, scene_list):
-    d = VSIF()
-    with open(vsif, "rb") as s:
-        d.unpack(s)
+    d = unpack_file(VSIF(), vsif)
 
     crcs = create_crc_mapping(d, scene_list)
 
     found = 0
     not_found = 0
-    for scene in d["scenes"]:
+    for i, scene in enumerate(d["scenes"]):
         crc = scene["namecrc"].data
         if crc in crcs:
             found += 1
@@ -260,10 +325,7 @@ def unpack(vsif, scene_list):
             # print("Can't find CRC {:x} with sounds {}".format(crc, scene["scenesummary"]["sounds"].data))
             name = "scenes/unknown-{:08x}.vcd".format(crc)
 
-        b = BVCD(d["strings"])
-        with BytesIO(scene["scene"]["scene_data"].data) as s:
-            b.unpack(s)
-            assert s.read(1) == b"", name
+        b = d.decode_scene(i, name)
 
         name = name.replace(".vcd", ".json")
 
@@ -276,4 +338,5 @@ def unpack(vsif, scene_list):
     print("Found {} scene names, couldn't find {} scene names".format(found, not_found))
 
 if __name__ == "__main__":
+    profile_from_environ()
     unpack(argv[1], argv[2])